@@ -0,0 +1,63 @@
+# -*- coding: UTF-8 -*-
+# Compares msmart.crc8 with the previous per byte implementation.
+# python benchmarks/crc8.py
+import os
+import sys
+import timeit
+
+# Run from a checkout without installing msmart
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msmart.crc8 as crc8  # noqa: E402
+
+
+def calculate_before(data):
+    crc_value = 0
+    for m in data:
+        k = crc_value ^ m
+        if k > 256:
+            k -= 256
+        if k < 0:
+            k += 256
+        crc_value = crc8.crc8_854_table[k]
+    return crc_value
+
+
+def checksum_before(frame):
+    return (~sum(frame[1:]) + 1) & 0xFF
+
+
+def measure(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    # A state reply payload and frame, then batches of them
+    payload = os.urandom(24)
+    frame = bytes([0xAA]) + os.urandom(35)
+    assert crc8.calculate(payload) == calculate_before(payload)
+    assert crc8.checksum(frame) == checksum_before(frame)
+    print("{:<28} {:>10} {:>10} {:>8}".format('', 'before us', 'after us', 'speedup'))
+
+    def row(name, before, after, number):
+        b, a = measure(before, number), measure(after, number)
+        print("{:<28} {:>10.2f} {:>10.2f} {:>7.1f}x".format(name, b, a, b / a))
+
+    row('crc8 24 bytes', lambda: calculate_before(payload), lambda: crc8.calculate(payload), 20000)
+    row('checksum 36 bytes', lambda: checksum_before(frame), lambda: crc8.checksum(frame), 50000)
+    for count in (8, 128, 1024, 4096):
+        payloads = [os.urandom(24) for _ in range(count)]
+        frames = [bytes([0xAA]) + os.urandom(35) for _ in range(count)]
+        assert crc8.calculate_many(payloads) == [calculate_before(p) for p in payloads]
+        assert crc8.checksum_many(frames) == [checksum_before(f) for f in frames]
+        number = max(1, 20000 // count)
+        row('crc8 batch {}'.format(count), lambda: [calculate_before(p) for p in payloads],
+            lambda: crc8.calculate_many(payloads), number)
+        row('checksum batch {}'.format(count), lambda: [checksum_before(f) for f in frames],
+            lambda: crc8.checksum_many(frames), number)
+    if crc8.numpy is None:
+        print('NumPy is not installed, batches use the pure Python path')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import time
+from msmart.circuit_breaker import circuit_breaker
+from msmart.const import MSGTYPE_ENCRYPTED_REQUEST
+from msmart.lan import LISTEN_TIMEOUT
+from msmart.lan_protocol import CLOSE, OPEN, SLEEP, lan_protocol, pending_request
+from msmart.log import get_logger, lazy, lazy_hex
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+
+class async_lan:
+    '''
+    asyncio version of lan, built on asyncio streams.
+    Framing, 8370 keys and resends are the lan_protocol shared with lan,
+    every method doing I/O is a coroutine here.
+    '''
+
+    def __init__(self, device_ip, device_id, device_port=6444):
+        self.device_ip = device_ip
+        self.device_id = device_id
+        self.device_port = device_port
+        self.protocol = lan_protocol(device_ip, device_id, device_port)
+        self._reader = None
+        self._writer = None
+        self._loop = None
+        self._async_lock = None
+        # Requests queued for the next write, see submit()
+        self._inflight = []
+        # Read a listener waits on outside the lock
+        self._listen_read = None
+        # Request replayed by keepalive(), set by the owning device
+        self.keepalive_data = None
+
+    async def _connect(self):
+        if self._writer is None:
+            self._disconnect()
+            _LOGGER.debug("Attempting new connection to {}:{}", self.device_ip, self.device_port)
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.device_ip, self.device_port), timeout=self.protocol.timeout)
+                self._loop = asyncio.get_running_loop()
+                self.protocol.connection_made(":".join(
+                    '%s' % i for i in self._writer.get_extra_info('sockname')))
+            except Exception as error:
+                _LOGGER.error("Connect Error: {}:{} {}", self.device_ip, self.device_port, error)
+                self._disconnect()
+
+    def _disconnect(self):
+        if self._listen_read is not None:
+            self._listen_read.cancel()
+            self._listen_read = None
+        if self._writer:
+            self._writer.close()
+            self._reader = None
+            self._writer = None
+            self.protocol.connection_lost()
+
+    async def close(self):
+        writer = self._writer
+        self._disconnect()
+        if writer:
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    def close_soon(self):
+        # close() for callers outside the event loop the stream belongs to
+        loop = self._loop
+        if self._writer is not None and loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._disconnect)
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    @property
+    def breaker(self):
+        return self.protocol.breaker
+
+    @property
+    def last_request(self):
+        return self.protocol.last_request
+
+    @property
+    def last_activity(self):
+        return self.protocol.last_activity
+
+    def get_socket_info(self):
+        return self.protocol.get_socket_info()
+
+    def set_token_key(self, token, key):
+        # May be called outside the loop, the next request reconnects
+        if self.protocol.set_token_key(token, key):
+            self.protocol.connection_lost()
+
+    def _get_lock(self):
+        # Created lazily so the lock belongs to the running loop
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        return self._async_lock
+
+    async def open_session(self):
+        # Reuse the live session, else resume a stored one or handshake
+        async with self._get_lock():
+            return await self._open_session()
+
+    async def _open_session(self):
+        if self._writer is not None and self.protocol._tcp_key is not None:
+            return True
+        _LOGGER.debug(
+            "Socket {} invalid, Create New Socket and Get New tcp_key {}", lazy(self.get_socket_info), self.protocol._tcp_key)
+        self._disconnect()
+        return await self._authenticate()
+
+    async def keepalive(self):
+        async with self._get_lock():
+            if not self.connected or self.keepalive_data is None:
+                return False
+            if self.breaker.state != circuit_breaker.state_enum.CLOSED:
+                return False
+            _LOGGER.debug("Keepalive {}", lazy(self.get_socket_info))
+            if self.protocol._tcp_key is not None:
+                packets = await self._run(self.protocol.transparent_send_8370(self.keepalive_data))
+            else:
+                packets = await self._run(self.protocol.transparent_send(self.keepalive_data))
+            return len(packets) > 0
+
+    async def receive(self, timeout=LISTEN_TIMEOUT):
+        '''
+        Wait for frames the device sends on its own, without sending a request.
+        Returns the decoded packets, [] on timeout and None once the connection is lost.
+        '''
+        async with self._get_lock():
+            await self._connect()
+            if self._writer is None:
+                return None
+            # A read left pending by the last call keeps waiting
+            if self._listen_read is None:
+                self._listen_read = asyncio.ensure_future(self._reader.read(1024))
+            read = self._listen_read
+        # Wait outside the lock, a request cancels the read before it uses the stream
+        try:
+            await asyncio.wait((read,), timeout=timeout)
+        except asyncio.CancelledError:
+            if self._listen_read is read:
+                self._listen_read = None
+                read.cancel()
+            raise
+        if not read.done():
+            return []
+        async with self._get_lock():
+            if self._listen_read is not read:
+                # A request took the stream and whatever the read got
+                return []
+            self._listen_read = None
+            if read.cancelled():
+                return []
+            try:
+                response = read.result()
+            except OSError as error:
+                _LOGGER.debug("Recv {} Error: {}", lazy(self.get_socket_info), error)
+                self._disconnect()
+                return None
+            if len(response) == 0:
+                _LOGGER.debug("Recv {} Server Closed Socket", lazy(self.get_socket_info))
+                self._disconnect()
+                return None
+            return self.protocol.decode(self.protocol.received(response))
+
+    async def _stop_listening(self):
+        # Called with the lock held before a request reads the stream, which
+        # allows a single reader. Returns what the listener already read.
+        read, self._listen_read = self._listen_read, None
+        if read is None:
+            return b''
+        if not read.done():
+            read.cancel()
+            await asyncio.wait((read,))
+        if not read.cancelled() and read.exception() is None:
+            return read.result()
+        return b''
+
+    async def _drain(self):
+        # Nothing read before the request is sent can be its reply
+        data = await self._stop_listening()
+        while True:
+            # A read of buffered data completes without waiting for the loop
+            read = asyncio.ensure_future(self._reader.read(1024))
+            await asyncio.sleep(0)
+            if not read.done():
+                read.cancel()
+                await asyncio.wait((read,))
+            if read.cancelled() or read.exception() is not None or not read.result():
+                break
+            data += read.result()
+        self.protocol.discard(data)
+
+    async def request(self, message):
+        frames, b = await self.request_frames(message)
+        return bytearray(b''.join(frames)), b
+
+    async def request_frames(self, message, timeout=None, sample=True, expected=1):
+        protocol = self.protocol
+        if timeout is None:
+            timeout = protocol.timeout
+        await self._connect()
+        if self._writer is None:
+            _LOGGER.error("Sokcet is None: {}", protocol._remote)
+            return [], False
+        _LOGGER.debug("Socket {} tcp_key: {}", lazy(self.get_socket_info), protocol._tcp_key)
+        await self._drain()
+        # Send data
+        try:
+            _LOGGER.debug(
+                "Sending {} message: {}", lazy(self.get_socket_info), lazy_hex(message))
+            self._writer.write(message)
+            await self._writer.drain()
+            send_time = time.time()
+        except Exception as error:
+            _LOGGER.error("Send {} Error: {}", lazy(self.get_socket_info), error)
+            self._disconnect()
+            protocol.failed()
+            return [], True
+
+        # Received data, until a complete frame per expected reply is buffered
+        frames = []
+        try:
+            await asyncio.wait_for(self._read_frames(expected, frames), timeout=timeout)
+        except asyncio.TimeoutError:
+            if protocol.timed_out(frames, expected, timeout):
+                return frames, True
+            return [], True
+        except OSError as error:
+            _LOGGER.debug("Recv {} Error: {}", lazy(self.get_socket_info), error)
+            self._disconnect()
+            protocol.failed()
+            return [], True
+        if not frames:
+            _LOGGER.debug("Recv {} Server Closed Socket", lazy(self.get_socket_info))
+            self._disconnect()
+            protocol.failed()
+            return [], True
+        protocol.replied(send_time, sample)
+        return frames, True
+
+    async def _read_frames(self, expected=1, frames=None):
+        # Fills frames in place, so a caller that times out keeps what came
+        if frames is None:
+            frames = []
+        while len(frames) < expected:
+            response = await self._reader.read(1024)
+            if len(response) == 0:
+                return frames
+            frames.extend(self.protocol.received(response))
+        return frames
+
+    async def authenticate(self, token: bytearray, key: bytearray):
+        request = self.protocol.handshake_request(token, key)
+        response, _ = await self.request(request)
+        return self.protocol.handshake(response)
+
+    async def _authenticate(self):
+        self.protocol.check_token_key()
+        await self._connect()
+        if self.connected and self.protocol.resume_session():
+            return True
+        return await self.authenticate(self.protocol._token, self.protocol._key)
+
+    async def _run(self, request):
+        # Perform the I/O a lan_protocol request generator asks for
+        result = None
+        while True:
+            try:
+                step = request.send(result)
+            except StopIteration as stop:
+                return stop.value
+            if step[0] == OPEN:
+                result = await self._open_session()
+            elif step[0] == CLOSE:
+                result = self._disconnect()
+            elif step[0] == SLEEP:
+                result = await asyncio.sleep(step[1])
+            else:
+                result = await self.request_frames(*step[1:])
+
+    async def _guarded(self, request):
+        # Run request behind the circuit breaker, an exception counts as a
+        # failure so a HALF_OPEN probe never leaves the breaker stuck
+        if not self.protocol.allow():
+            return []
+        try:
+            packets = await self._run(request)
+        except BaseException:
+            self.breaker.record_failure()
+            raise
+        return self.protocol.record(packets)
+
+    async def submit(self, packets, matchers, encrypted):
+        '''
+        Send packets, each with the matcher of its reply, and return the
+        replies to each. Packets other coroutines queue while an exchange runs
+        go out together in the next write, replies are routed by matcher.
+        '''
+        requests = [pending_request(bytes(packet), matches, encrypted) for packet, matches in zip(packets, matchers)]
+        self._inflight.extend(requests)
+        async with self._get_lock():
+            # The holder of the lock before us may have sent ours already
+            while not requests[0].done:
+                await self._send_inflight()
+        return [request.replies for request in requests]
+
+    async def _send_inflight(self):
+        batch = self.protocol.take_batch(self._inflight)
+        packets = []
+        try:
+            packets = await self._guarded(self.protocol.batch_request(batch))
+        finally:
+            self.protocol.correlate(batch, packets)
+
+    async def appliance_transparent_send_8370(self, data, msgtype=MSGTYPE_ENCRYPTED_REQUEST):
+        async with self._get_lock():
+            return await self._guarded(self.protocol.transparent_send_8370(data, msgtype))
+
+    async def appliance_transparent_send_8370_batch(self, packets, msgtype=MSGTYPE_ENCRYPTED_REQUEST):
+        # Every packet in one write, waiting for a reply to each
+        async with self._get_lock():
+            return await self._guarded(self.protocol.transparent_send_8370(
+                list(packets), msgtype, expected=len(packets)))
+
+    async def appliance_transparent_send(self, data):
+        async with self._get_lock():
+            return await self._guarded(self.protocol.transparent_send(data))
+
+    async def appliance_transparent_send_batch(self, packets):
+        # Every packet in one write, waiting for a reply to each
+        async with self._get_lock():
+            return await self._guarded(self.protocol.transparent_send(b''.join(packets), len(packets)))
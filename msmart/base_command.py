@@ -1,21 +1,23 @@
 
 from abc import ABC, abstractmethod
 from collections import namedtuple
-import logging
 import msmart.crc8 as crc8
 from msmart.const import FRAME_TYPE
+from msmart.log import get_logger, lazy_hex
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 
 class command(ABC):
-    _message_id = 0
+    # Payload ids of the replies to this command, empty accepts any reply
+    response_ids = ()
 
     def __init__(self, device_type=0xAC, FRAME_TYPE=FRAME_TYPE.Request):
         self.device_type = device_type
         self.FRAME_TYPE = FRAME_TYPE
         self.protocol_version = 0
+        self._msg_id = None
 
     def pack(self):
         # Create payload with message id
@@ -55,18 +57,40 @@ class command(ABC):
         # Calculate total frame checksum
         frame.append(command.checksum(frame))
 
-        _LOGGER.debug("Frame data: {}".format(frame.hex()))
+        _LOGGER.debug("Frame data: {}", lazy_hex(frame))
 
         return frame
 
     @staticmethod
     def checksum(frame):
-        return (~sum(frame[1:]) + 1) & 0xFF
+        return crc8.checksum(frame)
 
     @property
     def message_id(self):
-        command._message_id += 1
-        return command._message_id & 0xFF
+        # Devices allocate ids, a command packed on its own carries 0
+        return self._msg_id or 0
+
+    @message_id.setter
+    def message_id(self, message_id):
+        self._msg_id = message_id & 0xFF
+
+    def matches(self, frame):
+        # Is the appliance frame a reply to this command, by appliance type
+        # and reply payload id
+        if len(frame) < 12 or frame[2] != self.device_type:
+            return False
+        return not self.response_ids or frame[10] in self.response_ids
+
+    @property
+    def payload_key(self):
+        # Hashable key of the payload for commands whose payload only depends
+        # on it, so their packed frames can be cached. None disables caching.
+        return None
+
+    def frame_key(self):
+        if self.payload_key is None:
+            return None
+        return (self.device_type, self.FRAME_TYPE, self.protocol_version, self.payload_key, self.message_id)
 
     @property
     @abstractmethod
@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+from enum import IntEnum
+import random
+import threading
+import time
+from msmart.log import get_logger
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+# Consecutive failed exchanges before the breaker opens
+FAILURE_THRESHOLD = 3
+# First probe delay once open, doubled for every failed probe
+BASE_OPEN_TIME = 5
+MAX_OPEN_TIME = 300
+
+
+class circuit_breaker:
+    '''
+    Fails fast for unreachable devices.
+    CLOSED lets every request through, after failure_threshold failures the
+    breaker is OPEN and rejects requests until the probe time, then a single
+    HALF_OPEN probe either closes it again or reopens it for twice as long.
+    '''
+
+    class state_enum(IntEnum):
+        CLOSED = 0
+        OPEN = 1
+        HALF_OPEN = 2
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, base_open_time=BASE_OPEN_TIME, max_open_time=MAX_OPEN_TIME):
+        self.failure_threshold = failure_threshold
+        self.base_open_time = base_open_time
+        self.max_open_time = max_open_time
+        self._state = circuit_breaker.state_enum.CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def retry_at(self):
+        return self._retry_at
+
+    def allow(self):
+        with self._lock:
+            if self._state == circuit_breaker.state_enum.CLOSED:
+                return True
+            if self._state == circuit_breaker.state_enum.OPEN and time.time() >= self._retry_at:
+                # Let exactly one probe through
+                self._state = circuit_breaker.state_enum.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != circuit_breaker.state_enum.CLOSED:
+                _LOGGER.debug("Circuit closed after {} trips", self._trips)
+            self._state = circuit_breaker.state_enum.CLOSED
+            self._failures = 0
+            self._trips = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == circuit_breaker.state_enum.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._trips += 1
+                open_time = min(self.base_open_time * 2 ** (self._trips - 1), self.max_open_time)
+                # Jitter so a fleet of dead units does not probe in lockstep
+                open_time *= random.uniform(0.8, 1.2)
+                self._retry_at = time.time() + open_time
+                self._state = circuit_breaker.state_enum.OPEN
+                _LOGGER.debug("Circuit open, next probe in {:.1f}s", open_time)
@@ -2,6 +2,7 @@
 # -*- coding: UTF-8 -*-
 import asyncio
 from msmart.const import OPEN_MIDEA_APP_ACCOUNT, OPEN_MIDEA_APP_PASSWORD
+from msmart.log import get_logger
 import click
 import logging
 import sys
@@ -17,7 +18,7 @@ if sys.version_info < (3, 5):
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 
 @click.command()
 @click.option("-d", "--debug", default=False, count=True, help='Enable debug logging')
@@ -38,7 +39,7 @@ def discover(debug: bool, amount: int, account:str, password:str, ip: str, china
         _LOGGER.info("Debug mode active")
     else:
         logging.basicConfig(level=logging.INFO)
-    _LOGGER.info("msmart version: {} Currently only supports ac devices, only support MSmartHome and 美的美居 APP.".format(VERSION))
+    _LOGGER.info("msmart version: {} Currently only supports ac devices, only support MSmartHome and 美的美居 APP.", VERSION)
     os.environ['USE_CHINA_SERVER']=str(china)
     if china:
         if account == OPEN_MIDEA_APP_ACCOUNT or password == OPEN_MIDEA_APP_PASSWORD:
@@ -54,7 +55,7 @@ def discover(debug: bool, amount: int, account:str, password:str, ip: str, china
             _LOGGER.error("*** \033[0;31mDevice not found, please read: https://github.com/mac-zhou/midea-ac-py#how-to-get-configuration-variables \033[0m")
         else:
             for device in found_devices:
-                _LOGGER.info("*** Found a device: \033[94m\033[1m{} \033[0m".format(device))
+                _LOGGER.info("*** Found a device: \033[94m\033[1m{} \033[0m", device)
     except KeyboardInterrupt:
         sys.exit(0)
 
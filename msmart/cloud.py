@@ -1,11 +1,11 @@
 # -*- coding: UTF-8 -*-
 from datetime import datetime
 import json
-import logging
 import requests
 from time import time
 
 from threading import Lock
+from msmart.log import get_logger, lazy_hex
 from msmart.security import security
 # from msmart.security import loginKey
 from secrets import token_hex, token_urlsafe
@@ -16,7 +16,7 @@ import os
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 
 
 class cloud:
@@ -55,7 +55,7 @@ class cloud:
         self.SERVER_URL = 'https://mp-prod.appsmb.com/mas/v5/app/proxy?alias='
         if self._use_china_server:
             self.SERVER_URL = 'https://mp-prod.smartmidea.net/mas/v5/app/proxy?alias='
-        _LOGGER.info("Using Midea cloud server: {} {}".format(self.SERVER_URL, self._use_china_server))
+        _LOGGER.info("Using Midea cloud server: {} {}", self.SERVER_URL, self._use_china_server)
 
     def api_request(self, endpoint, args=None, data=None):
         """
@@ -106,7 +106,7 @@ class cloud:
                 data=json.dumps(data),
                 # verify=False
             )
-            _LOGGER.debug("Response: {}".format(r.text))
+            _LOGGER.debug("Response: {}", r.text)
             response = json.loads(r.text)
         finally:
             self._api_lock.release()
@@ -115,7 +115,7 @@ class cloud:
         if int(response['code']) != 0:
             self.handle_api_error(int(response['code']), response['msg'])
             # If you don't throw, then retry
-            _LOGGER.debug("Retrying API call: '{}'".format(endpoint))
+            _LOGGER.debug("Retrying API call: '{}'", endpoint)
             self._retries += 1
             if(self._retries < 3):
                 return self.api_request(endpoint, args)
@@ -186,7 +186,7 @@ class cloud:
         })
 
         self.appliance_list = response['list']
-        _LOGGER.debug("Device list: {}".format(self.appliance_list))
+        _LOGGER.debug("Device list: {}", self.appliance_list)
         return self.appliance_list
 
     def gettoken(self, udpid):
@@ -224,7 +224,7 @@ class cloud:
         if not self.session:
             self.login()
 
-        _LOGGER.debug("Sending to {}: {}".format(id, data.hex()))
+        _LOGGER.debug("Sending to {}: {}", id, lazy_hex(data))
         encoded = self.encode(data)
         order = self.security.aes_encrypt(encoded)
         response = self.api_request('appliance/transparent/send', {
@@ -236,7 +236,7 @@ class cloud:
         reply = self.decode(self.security.aes_decrypt(
             bytearray.fromhex(response['reply'])))
 
-        _LOGGER.debug("Recieved from {}: {}".format(id, reply.hex()))
+        _LOGGER.debug("Recieved from {}: {}", id, lazy_hex(reply))
         return reply
 
     def list_homegroups(self, force_update=False):
@@ -254,13 +254,13 @@ class cloud:
     def handle_api_error(self, error_code, message: str):
 
         def restart_full():
-            _LOGGER.debug("Restarting full: '{}' - '{}'".format(error_code, message))
+            _LOGGER.debug("Restarting full: '{}' - '{}'", error_code, message)
             self.session = None
             self.get_login_id()
             self.login()
 
         def session_restart():
-            _LOGGER.debug("Restarting session: '{}' - '{}'".format(error_code, message))
+            _LOGGER.debug("Restarting session: '{}' - '{}'", error_code, message)
             self.session = None
             self.login()
 
@@ -268,7 +268,7 @@ class cloud:
             raise ValueError(error_code, message)
 
         def ignore():
-            _LOGGER.debug("Error ignored: '{}' - '{}'".format(error_code, message))
+            _LOGGER.debug("Error ignored: '{}' - '{}'", error_code, message)
 
         error_handlers = {
             3176: ignore,          # The asyn reply does not exist.
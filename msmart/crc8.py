@@ -1,5 +1,13 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 VERSION = '0.2.5'
 
+# Below this many frames the per call NumPy overhead outweighs the gain
+BATCH_THRESHOLD = 128
+
 # The huge CRC table! Aparently this can be generated, but storage space is cheap...
 crc8_854_table = [
     0x00, 0x5E, 0xBC, 0xE2, 0x61, 0x3F, 0xDD, 0x83,
@@ -38,12 +46,58 @@ crc8_854_table = [
 
 
 def calculate(data):
+    # Bytes and the crc are both below 256, so the index needs no range checks
+    table = crc8_854_table
     crc_value = 0
     for m in data:
-        k = crc_value ^ m
-        if k > 256:
-            k -= 256
-        if k < 0:
-            k += 256
-        crc_value = crc8_854_table[k]
+        crc_value = table[crc_value ^ m]
     return crc_value
+
+
+def checksum(frame):
+    # Two's complement of the sum of every byte after the 0xAA start byte,
+    # without copying frame[1:]
+    return (frame[0] - sum(frame)) & 0xFF
+
+
+def _flatten(frames):
+    # All frames in one uint8 array plus the length of each
+    flat = numpy.frombuffer(b''.join(frames), dtype=numpy.uint8)
+    lengths = numpy.fromiter(map(len, frames), dtype=numpy.int64, count=len(frames))
+    return flat, lengths
+
+
+def _matrix(flat, lengths):
+    # Frames as rows of a uint8 matrix, right aligned with zeros in front
+    width = int(lengths.max())
+    if (lengths == width).all():
+        return flat.reshape(len(lengths), width)
+    matrix = numpy.zeros((len(lengths), width), dtype=numpy.uint8)
+    matrix[numpy.arange(width) >= (width - lengths)[:, None]] = flat
+    return matrix
+
+
+def calculate_many(frames):
+    '''CRC8 of every buffer in frames, vectorised across frames with NumPy.'''
+    if numpy is None or len(frames) < BATCH_THRESHOLD:
+        return [calculate(frame) for frame in frames]
+    # table[0] is 0, so the leading zero padding leaves the crc unchanged
+    crc = numpy.zeros(len(frames), dtype=numpy.uint8)
+    for column in _matrix(*_flatten(frames)).T:
+        crc = _numpy_table[crc ^ column]
+    return crc.tolist()
+
+
+def checksum_many(frames):
+    '''checksum() of every frame in frames, vectorised across frames with NumPy.'''
+    if numpy is None or len(frames) < BATCH_THRESHOLD:
+        return [checksum(frame) for frame in frames]
+    flat, lengths = _flatten(frames)
+    offsets = numpy.zeros(len(frames), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1], out=offsets[1:])
+    total = numpy.add.reduceat(flat, offsets, dtype=numpy.int64)
+    return ((flat[offsets].astype(numpy.int64) - total) & 0xFF).tolist()
+
+
+if numpy is not None:
+    _numpy_table = numpy.array(crc8_854_table, dtype=numpy.uint8)
@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+from functools import lru_cache
+from hashlib import sha256
+import os
+import timeit
+from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
+from msmart.log import get_logger
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+# Every AES-CBC use in the protocol has a zero iv
+IV = b'\0' * 16
+
+
+class crypto_backend:
+    '''
+    AES-ECB, AES-CBC with a zero iv, SHA-256 signing and XOR.
+    Hashing is hashlib (OpenSSL) in every backend, it is faster than either
+    library's own implementation.
+    '''
+    name = None
+
+    def sign(self, data):
+        return sha256(data).digest()
+
+    def random_bytes(self, size):
+        return os.urandom(size)
+
+
+class pycryptodome_backend(crypto_backend):
+    name = 'pycryptodome'
+
+    def __init__(self):
+        # ECB holds no state between calls, so the key schedule is reused
+        self._ecb = lru_cache(maxsize=64)(lambda key: AES.new(key, AES.MODE_ECB))
+
+    def ecb_encrypt(self, key, data):
+        return self._ecb(bytes(key)).encrypt(data)
+
+    def ecb_decrypt(self, key, data):
+        return self._ecb(bytes(key)).decrypt(data)
+
+    def cbc_encrypt(self, key, data):
+        # Chaining blocks through ECB in Python is slower than a new context
+        return AES.new(bytes(key), AES.MODE_CBC, iv=IV).encrypt(data)
+
+    def cbc_decrypt(self, key, data):
+        # CBC decryption is ECB of every block xored with the previous
+        # ciphertext block, so the cached key schedule covers it. pycryptodome
+        # handles bytes faster than views, frames are small
+        data = bytes(data)
+        return strxor(self._ecb(bytes(key)).decrypt(data), IV + data[:-16])
+
+    def xor(self, a, b):
+        return strxor(a, b)
+
+
+class cryptography_backend(crypto_backend):
+    name = 'cryptography'
+
+    def __init__(self):
+        self._ecb = lru_cache(maxsize=64)(lambda key: Cipher(algorithms.AES(key), modes.ECB()))
+        self._cbc = lru_cache(maxsize=64)(lambda key: Cipher(algorithms.AES(key), modes.CBC(IV)))
+
+    def ecb_encrypt(self, key, data):
+        context = self._ecb(bytes(key)).encryptor()
+        return context.update(data) + context.finalize()
+
+    def ecb_decrypt(self, key, data):
+        context = self._ecb(bytes(key)).decryptor()
+        return context.update(data) + context.finalize()
+
+    def cbc_encrypt(self, key, data):
+        context = self._cbc(bytes(key)).encryptor()
+        return context.update(data) + context.finalize()
+
+    def cbc_decrypt(self, key, data):
+        context = self._cbc(bytes(key)).decryptor()
+        return context.update(data) + context.finalize()
+
+    def xor(self, a, b):
+        if len(a) != len(b):
+            raise ValueError('Only byte strings of equal length can be xored')
+        return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def available_backends():
+    backends = [pycryptodome_backend]
+    if Cipher is not None:
+        backends.append(cryptography_backend)
+    return backends
+
+
+def benchmark(backend, rounds=50):
+    # One 8370 round trip: CBC both ways, the inner ECB layer and the signs
+    key, data = bytes(range(32)), bytes(range(96))
+
+    def run():
+        encrypted = backend.cbc_encrypt(key, data)
+        backend.sign(data)
+        backend.ecb_decrypt(key[:16], backend.cbc_decrypt(key, encrypted)[:64])
+        backend.sign(data)
+    return min(timeit.repeat(run, number=rounds, repeat=3)) / rounds
+
+
+_backend = None
+
+
+def get_backend():
+    '''
+    Backend used for bulk traffic, MSMART_CRYPTO_BACKEND names one explicitly,
+    otherwise the fastest available one is picked on first use.
+    '''
+    global _backend
+    if _backend is None:
+        backends = {backend.name: backend for backend in available_backends()}
+        name = os.getenv('MSMART_CRYPTO_BACKEND')
+        if name in backends:
+            _backend = backends[name]()
+        else:
+            if name:
+                _LOGGER.warning("Crypto backend {} is not available, using the fastest of {}", name, ', '.join(backends))
+            timings = {}
+            for backend in backends.values():
+                backend = backend()
+                timings[backend] = benchmark(backend)
+            _backend = min(timings, key=timings.get)
+            _LOGGER.debug("Crypto backend {} ({})", _backend.name, ', '.join(
+                "{}: {:.1f}us".format(backend.name, timing * 1e6) for backend, timing in timings.items()))
+    return _backend
+
+
+def set_backend(name):
+    global _backend
+    backends = {backend.name: backend for backend in available_backends()}
+    if name not in backends:
+        raise ValueError('unknown crypto backend {}'.format(name))
+    _backend = backends[name]()
+    return _backend
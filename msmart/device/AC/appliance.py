@@ -1,14 +1,35 @@
 
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import IntEnum
-import logging
+import threading
 from .command import ResponseId, response as base_response
 from .command import state_response, capabilities_response
 from .command import get_state_command, set_state_command, get_capabilities_command
 from msmart.device.base import device
+from msmart.log import get_logger, lazy_hex
+from msmart.store import default_capability_store
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
+
+# Seconds apply() waits for further changes to send them as one command,
+# 0 sends at once
+APPLY_DEBOUNCE = 0
+# Threads shared by the apply_optimistic() of every device
+APPLY_WORKERS = 4
+
+_apply_executor = None
+_apply_executor_lock = threading.Lock()
+
+
+def _shared_executor():
+    global _apply_executor
+    with _apply_executor_lock:
+        if _apply_executor is None:
+            _apply_executor = ThreadPoolExecutor(max_workers=APPLY_WORKERS, thread_name_prefix='msmart-apply')
+        return _apply_executor
 
 
 class IntEnumHelper(IntEnum):
@@ -18,11 +39,12 @@ class IntEnumHelper(IntEnum):
 
     @staticmethod
     def get(enum_class, value, default=None):
-        try:
-            return enum_class(value)
-        except ValueError:
-            _LOGGER.debug("Unknown {}: {}".format(enum_class, value))
+        # Enums keep a value to member table, unknown values do not raise
+        member = enum_class._value2member_map_.get(value)
+        if member is None:
+            _LOGGER.debug("Unknown {}: {}", enum_class, value)
             return default
+        return member
 
 
 class air_conditioning(device):
@@ -72,6 +94,13 @@ class air_conditioning(device):
         def get(value):
             return IntEnumHelper.get(__class__, value, air_conditioning.swing_mode_enum.Off)
 
+    _state_fields = ('power_state', 'target_temperature', 'operational_mode', 'fan_speed', 'swing_mode',
+                     'eco_mode', 'turbo_mode', 'fahrenheit', 'indoor_temperature', 'outdoor_temperature')
+
+    # Attributes of the settings sent by apply()
+    _settings = ('_power_state', '_target_temperature', '_operational_mode', '_fan_speed', '_swing_mode',
+                 '_eco_mode', '_turbo_mode', '_fahrenheit_unit')
+
     def __init__(self, *args, **kwargs):
         super(air_conditioning, self).__init__(*args, **kwargs)
         self._prompt_tone = False
@@ -97,77 +126,279 @@ class air_conditioning(device):
         self._indoor_temperature = 0.0
         self._outdoor_temperature = 0.0
 
+        # Settings changed locally and not sent yet, and the set payload
+        # matching the last state read from the device
+        self._dirty = set()
+        self._confirmed_payload = None
+        self._confirmed_state = None
+        # Future of the last apply_optimistic(), the next one runs after it
+        self._apply_future = None
+        self.apply_debounce = APPLY_DEBOUNCE
+        self._apply_timer = None
+        self._apply_task = None
+        self._apply_lock = threading.Lock()
+
     def __str__(self):
         return str(self.__dict__)
 
-    def get_capabilities(self):
+    def get_capabilities(self, force=False):
+        # Known models are served from the capability store
+        if not force and self._load_capabilities():
+            return
         cmd = get_capabilities_command(self.type)
         self._send_cmd(cmd)
 
+    def _capability_key(self):
+        return self.model or self.sn
+
+    def _load_capabilities(self):
+        store = default_capability_store()
+        key = self._capability_key()
+        if store is None or not key:
+            return False
+        capabilities = store.get_capabilities(key)
+        if capabilities is None:
+            return False
+        self.update_capabilities(capabilities_response.from_capabilities(capabilities))
+        return True
+
+    def _store_capabilities(self, res: capabilities_response):
+        store = default_capability_store()
+        key = self._capability_key()
+        if store is not None and key and res.capabilities:
+            store.set_capabilities(key, res.capabilities)
+
+    def _state_command(self):
+        return get_state_command(self.type)
+
+    def _startup_commands(self, force):
+        cmds = [self._state_command()]
+        if force or not self._load_capabilities():
+            cmds.insert(0, get_capabilities_command(self.type))
+        return cmds
+
+    def initialize(self, force=False):
+        '''
+        Read capabilities, unless they are cached, and state in one round trip.
+        '''
+        for response in self.send_batch(self._startup_commands(force)):
+            self._process_response(response)
+
+    async def async_initialize(self, force=False):
+        for response in await self.async_send_batch(self._startup_commands(force)):
+            self._process_response(response)
+
     def refresh(self):
-        cmd = get_state_command(self.type)
+        cmd = self._state_command()
         self._send_cmd(cmd)
+
+    async def async_get_capabilities(self, force=False):
+        if not force and self._load_capabilities():
+            return
+        cmd = get_capabilities_command(self.type)
+        await self._async_send_cmd(cmd)
+
+    async def async_refresh(self):
+        cmd = self._state_command()
+        await self._async_send_cmd(cmd)
     
     def _send_cmd(self, cmd):
         responses = self.send_cmd(cmd)
         for response in responses:
             self._process_response(response)
 
+    async def _async_send_cmd(self, cmd):
+        responses = await self.async_send_cmd(cmd)
+        for response in responses:
+            self._process_response(response)
+
     def _process_response(self, data):
         if self.process_response(data):
+            self._defer_update = False
+            self._support = True
+            # Most polls repeat the last state, skip decoding it again
+            if self._unchanged(data):
+                return
+
             # Construct response from data
             response = base_response.construct(data)
 
-            self._defer_update = False
-            self._support = True
             if not self._defer_update:
                 if response.id == ResponseId.State:
-                    self.update(response)
+                    self._apply_update(self.update, data, response)
                 elif response.id == ResponseId.Capabilities:
                     self.update_capabilities(response)
+                    self._store_capabilities(response)
                 elif response.id == 0xa1 or response.id == 0xa0:
-                    _LOGGER.warn("Ignored special response. {}:{} {}".format(
-                        self.ip, self.port, response.payload.hex()))
+                    _LOGGER.throttled_warning("Ignored special response. {}:{} {}", self.ip, self.port, lazy_hex(response.payload))
                     return
 
                 self._defer_update = False
         elif not self._keep_last_known_online_state:
             self._online = False
 
-    def apply(self):
+    def apply(self, force=False):
+        '''
+        Send the settings to the device. With apply_debounce set, this returns
+        at once and changes made within the window go out as one command.
+        Nothing is sent when the device already has the settings, unless force.
+        '''
+        if self.apply_debounce > 0 and not force:
+            with self._apply_lock:
+                if self._apply_timer is None:
+                    self._apply_timer = threading.Timer(self.apply_debounce, self._apply_now)
+                    self._apply_timer.daemon = True
+                    self._apply_timer.start()
+            return
+        self._apply_now(force)
+
+    def _apply_now(self, force=False):
+        with self._apply_lock:
+            if self._apply_timer is not None:
+                self._apply_timer.cancel()
+                self._apply_timer = None
         self._updating = True
         try:
-            # Warn if trying to apply unsupported modes
-            if self._operational_mode not in self._supported_op_modes:
-                _LOGGER.warn("Device is not capable of operational mode {}.".format(
-                    self._operational_mode))
-
-            if self._swing_mode not in self._supported_swing_modes:
-                _LOGGER.warn(
-                    "Device is not capable of swing mode {}.".format(self._swing_mode))
-
-            if self._turbo_mode and not self._supports_turbo:
-                _LOGGER.warn("Device is not capable of turbo mode.")
-
-            if self._eco_mode and not self._supports_eco:
-                _LOGGER.warn("Device is not capable of eco mode.")
-
-            cmd = set_state_command(self.type)
-            cmd.beep_on = self._prompt_tone
-            cmd.power_on = self._power_state
-            cmd.target_temperature = self._target_temperature
-            cmd.operational_mode = self._operational_mode
-            cmd.fan_speed = self._fan_speed
-            cmd.swing_mode = self._swing_mode
-            cmd.eco_mode = self._eco_mode
-            cmd.turbo_mode = self._turbo_mode
-            cmd.fahrenheit = self._fahrenheit_unit
-            self._send_cmd(cmd)
+            cmd = self._pending_set_command(force)
+            if cmd is not None:
+                self._send_cmd(cmd)
+            return cmd
         finally:
             self._updating = False
             self._defer_update = False
 
+    def apply_optimistic(self, on_divergence=None):
+        '''
+        Keep the new settings locally and send them in the background.
+        Returns a concurrent.futures.Future that resolves to True once the
+        device echoes them, or None when the echo holds values the model does
+        not know and cannot be compared. Otherwise the settings roll back to
+        the state the device last reported, on_divergence(device) is called
+        and the future resolves to False.
+        '''
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self._confirm(self._apply_now(), on_divergence))
+            except BaseException as error:
+                future.set_exception(error)
+
+        with self._apply_lock:
+            previous, self._apply_future = self._apply_future, future
+        # Applies of a device run in order, queued behind the previous one
+        # rather than waiting for it on a worker
+        if previous is None:
+            _shared_executor().submit(run)
+        else:
+            previous.add_done_callback(lambda _: _shared_executor().submit(run))
+        return future
+
+    def async_apply_optimistic(self, on_divergence=None):
+        '''asyncio version of apply_optimistic(), returns a Task.'''
+        async def apply():
+            return self._confirm(await self._async_apply_now(), on_divergence)
+        return asyncio.ensure_future(apply())
+
+    def _confirm(self, cmd, on_divergence):
+        # The reply to the set command updated the confirmed payload
+        if cmd is None or self._confirmed_payload == self._state_payload(cmd):
+            return True
+        if self._confirmed_payload is None:
+            # Values the enums do not know were echoed, keep the settings
+            _LOGGER.debug("Settings applied to {}:{} could not be confirmed, unknown values reported", self.ip, self.port)
+            return None
+        _LOGGER.warning("Settings applied to {}:{} were not confirmed, rolling back", self.ip, self.port)
+        if self._confirmed_state is not None:
+            for attr, value in self._confirmed_state.items():
+                # Newer local changes wait for their own apply
+                if attr not in self._dirty:
+                    setattr(self, attr, value)
+        if on_divergence is not None:
+            try:
+                on_divergence(self)
+            except Exception:
+                _LOGGER.exception("Divergence callback failed for {}:{}", self.ip, self.port)
+        return False
+
+    async def async_apply(self, force=False):
+        if self.apply_debounce > 0 and not force:
+            # Every caller in the window waits for the one merged command
+            if self._apply_task is None:
+                self._apply_task = asyncio.ensure_future(self._async_apply_later())
+            await asyncio.shield(self._apply_task)
+            return
+        await self._async_apply_now(force)
+
+    async def _async_apply_later(self):
+        await asyncio.sleep(self.apply_debounce)
+        # Changes made from here on need another command
+        self._apply_task = None
+        await self._async_apply_now()
+
+    async def _async_apply_now(self, force=False):
+        self._updating = True
+        try:
+            cmd = self._pending_set_command(force)
+            if cmd is not None:
+                await self._async_send_cmd(cmd)
+            return cmd
+        finally:
+            self._updating = False
+            self._defer_update = False
+
+    def _pending_set_command(self, force):
+        cmd = self._build_set_command()
+        self._dirty.clear()
+        if not force and self._confirmed_payload is not None and \
+                self._state_payload(cmd) == self._confirmed_payload:
+            _LOGGER.debug("Skipped apply to {}:{}, the device already has these settings", self.ip, self.port)
+            return None
+        return cmd
+
+    @staticmethod
+    def _state_payload(cmd):
+        # Set payload without the beep, which is not device state
+        beep, cmd.beep_on = cmd.beep_on, False
+        payload = cmd.payload
+        cmd.beep_on = beep
+        return payload
+
+    def _build_set_command(self):
+        # Warn if trying to apply unsupported modes
+        if self._operational_mode not in self._supported_op_modes:
+            _LOGGER.throttled_warning("Device {}:{} is not capable of operational mode {}.", self.ip, self.port, self._operational_mode)
+
+        if self._swing_mode not in self._supported_swing_modes:
+            _LOGGER.throttled_warning(
+                "Device {}:{} is not capable of swing mode {}.", self.ip, self.port, self._swing_mode)
+
+        if self._turbo_mode and not self._supports_turbo:
+            _LOGGER.throttled_warning("Device {}:{} is not capable of turbo mode.", self.ip, self.port)
+
+        if self._eco_mode and not self._supports_eco:
+            _LOGGER.throttled_warning("Device {}:{} is not capable of eco mode.", self.ip, self.port)
+
+        return self._set_command()
+
+    def _set_command(self):
+        cmd = set_state_command(self.type)
+        cmd.beep_on = self._prompt_tone
+        cmd.power_on = self._power_state
+        cmd.target_temperature = self._target_temperature
+        cmd.operational_mode = self._operational_mode
+        cmd.fan_speed = self._fan_speed
+        cmd.swing_mode = self._swing_mode
+        cmd.eco_mode = self._eco_mode
+        cmd.turbo_mode = self._turbo_mode
+        cmd.fahrenheit = self._fahrenheit_unit
+        return cmd
+
     def update(self, res: state_response):
+        pending = {attr: getattr(self, attr) for attr in self._dirty}
+
         self._power_state = res.power_on
 
         self._target_temperature = res.target_temperature
@@ -193,6 +424,16 @@ class air_conditioning(device):
         # self._on_timer = res.on_timer
         # self._off_timer = res.off_timer
 
+        # Only skip writes while the model holds exactly what was reported,
+        # values the enums do not know were replaced by a default
+        exact = self._operational_mode == res.operational_mode and self._fan_speed == res.fan_speed \
+            and self._swing_mode == res.swing_mode
+        self._confirmed_payload = self._state_payload(self._set_command()) if exact else None
+        self._confirmed_state = {attr: getattr(self, attr) for attr in air_conditioning._settings}
+        # Keep settings changed locally that were not applied yet
+        for attr, value in pending.items():
+            setattr(self, attr, value)
+
     def update_capabilities(self, res: capabilities_response):
         # Build list of supported operation modes
         op_modes = [air_conditioning.operational_mode_enum.fan_only]
@@ -221,6 +462,12 @@ class air_conditioning(device):
         self._supports_eco = res.eco_mode
         self._supports_turbo = res.turbo_mode
 
+    def _set(self, attr, value):
+        if self._updating:
+            self._defer_update = True
+        setattr(self, attr, value)
+        self._dirty.add(attr)
+
     @property
     def prompt_tone(self):
         return self._prompt_tone
@@ -237,9 +484,7 @@ class air_conditioning(device):
 
     @power_state.setter
     def power_state(self, state: bool):
-        if self._updating:
-            self._defer_update = True
-        self._power_state = state
+        self._set('_power_state', state)
 
     @property
     def target_temperature(self):
@@ -247,9 +492,7 @@ class air_conditioning(device):
 
     @target_temperature.setter
     def target_temperature(self, temperature_celsius: float):
-        if self._updating:
-            self._defer_update = True
-        self._target_temperature = temperature_celsius
+        self._set('_target_temperature', temperature_celsius)
 
     @property
     def operational_mode(self):
@@ -257,9 +500,7 @@ class air_conditioning(device):
 
     @operational_mode.setter
     def operational_mode(self, mode: operational_mode_enum):
-        if self._updating:
-            self._defer_update = True
-        self._operational_mode = mode
+        self._set('_operational_mode', mode)
 
     @property
     def fan_speed(self):
@@ -267,9 +508,7 @@ class air_conditioning(device):
 
     @fan_speed.setter
     def fan_speed(self, speed: fan_speed_enum):
-        if self._updating:
-            self._defer_update = True
-        self._fan_speed = speed
+        self._set('_fan_speed', speed)
 
     @property
     def swing_mode(self):
@@ -277,9 +516,7 @@ class air_conditioning(device):
 
     @swing_mode.setter
     def swing_mode(self, mode: swing_mode_enum):
-        if self._updating:
-            self._defer_update = True
-        self._swing_mode = mode
+        self._set('_swing_mode', mode)
 
     @property
     def eco_mode(self):
@@ -287,9 +524,7 @@ class air_conditioning(device):
 
     @eco_mode.setter
     def eco_mode(self, enabled: bool):
-        if self._updating:
-            self._defer_update = True
-        self._eco_mode = enabled
+        self._set('_eco_mode', enabled)
 
     @property
     def turbo_mode(self):
@@ -297,9 +532,7 @@ class air_conditioning(device):
 
     @turbo_mode.setter
     def turbo_mode(self, enabled: bool):
-        if self._updating:
-            self._defer_update = True
-        self._turbo_mode = enabled
+        self._set('_turbo_mode', enabled)
 
     @property
     def fahrenheit(self):
@@ -307,9 +540,7 @@ class air_conditioning(device):
 
     @fahrenheit.setter
     def fahrenheit(self, enabled: bool):
-        if self._updating:
-            self._defer_update = True
-        self._fahrenheit_unit = enabled
+        self._set('_fahrenheit_unit', enabled)
 
     @property
     def indoor_temperature(self):
@@ -1,17 +1,16 @@
 
 from abc import ABC, abstractmethod
-from collections import namedtuple
 from enum import IntEnum
-import logging
 import math
 import msmart.crc8 as crc8
-import struct
 from msmart.const import FRAME_TYPE
 from msmart.base_command import command
+from msmart.log import get_logger, lazy_hex
+from msmart.schema import bits, byte, const, flag, schema
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 
 
 class ResponseId(IntEnum):
@@ -49,10 +48,142 @@ class temperature_type(IntEnum):
     Indoor = 0x2
     Outdoor = 0x3
 
+
+def _capability_readers():
+    # Functions to parse capability values
+    def get_bool(v): return v != 0
+    def get_value(w): return lambda v: v == w
+    def get_no_value(w): return lambda v: v != w
+
+    # Map of capability ID to (name, read) pairs
+    readers = {
+        CapabilityId.IndoorHumidity: [("indoor_humidity", get_bool)],
+        CapabilityId.SilkyCool: [("silky_cool", get_value(1))],
+        CapabilityId.SmartEye: [("smart_eye", get_value(1))],
+        CapabilityId.WindOnMe: [("wind_on_me", get_value(1))],
+        CapabilityId.WindOffMe: [("wind_off_me", get_value(1))],
+        CapabilityId.ActiveClean: [("active_clean", get_value(1))],
+        CapabilityId.OneKeyNoWindOnMe: [("one_key_no_wind_on_me", get_value(1))],
+        CapabilityId.BreezeControl: [("breeze_control", get_value(1))],
+        # Fan speed control always seems to return false, even if unit can
+        CapabilityId.FanSpeedControl: [("fan_speed_control", get_no_value(1))],
+        CapabilityId.PresetEco: [
+            ("eco_mode", get_value(1)),
+            ("eco_mode_2", get_value(2)),
+        ],
+        CapabilityId.PresetFreezeProtection: [("freeze_protection", get_value(1))],
+        CapabilityId.Modes: [
+            ("heat_mode", lambda v: v == 1 or v == 2),
+            ("cool_mode", lambda v: v == 0 or v == 3),
+            ("dry_mode", lambda v: v < 2),
+            ("auto_mode", lambda v: v < 3),
+        ],
+        CapabilityId.SwingModes: [
+            ("swing_horizontal", lambda v: v == 1 or v == 3),
+            ("swing_vertical", lambda v: v < 2),
+        ],
+        CapabilityId.Power: [
+            ("power_cal", lambda v: v == 2 or v == 3),
+            ("power_cal_setting", lambda v: v == 3),
+        ],
+        CapabilityId.Nest: [
+            ("nest_check", lambda v: v == 1 or v == 2 or v == 4),
+            ("nest_need_change", lambda v: v == 3 or v == 4),
+        ],
+        CapabilityId.AuxElectricHeat: [("aux_electric_heat", get_bool)],
+        CapabilityId.PresetTurbo: [
+            ("turbo_heat", lambda v: v == 1 or v == 3),
+            ("turbo_cool", lambda v: v < 2),
+        ],
+        CapabilityId.Humidity: [
+            ("humidity_auto_set", lambda v: v == 1 or v == 2),
+            ("humidity_manual_set", lambda v: v == 2 or v == 3),
+        ],
+        CapabilityId.UnitChangeable: [("unit_changeable", get_value(0))],
+        CapabilityId.LightControl: [("light_control", get_bool)],
+        # Temperatures capability too complex to be handled here
+        CapabilityId.Buzzer: [("buzzer", get_bool)],
+    }
+
+    # Dispatch array indexed by the 16 bit ID, None where there is no reader
+    table = [None] * (max(readers) + 1)
+    for cap_id, reader in readers.items():
+        table[cap_id] = tuple(reader)
+    return tuple(table)
+
+
+CAPABILITY_READERS = _capability_readers()
+
+
+# Set state payload, the target temperature is 16 + temperature (+ 0.5)
+SET_STATE = schema('set_state_record', 24, [
+    # Set state
+    const(0, 0x40),
+    # Beep and power state
+    flag('beep_on', 1, 0x42),
+    flag('power_on', 1, 0x01),
+    # Temperature and operational mode
+    bits('temperature', 2, 0, 3),
+    flag('temperature_half', 2, 0x10),
+    bits('operational_mode', 2, 5, 7),
+    # Fan speed
+    byte('fan_speed', 3),
+    # Unknown
+    const(4, 0x7F),
+    const(5, 0x7F),
+    # Swing mode
+    const(7, 0x30),
+    bits('swing_mode', 7, 0, 5),
+    # Alternate turbo mode
+    flag('turbo_mode_alt', 8, 0x20),
+    # ECO mode
+    flag('eco_mode', 9, 0x80),
+    # Turbo mode, display on and fahrenheit
+    flag('sleep', 10, 0x01),
+    flag('turbo_mode', 10, 0x02),
+    flag('fahrenheit', 10, 0x04),
+    flag('display_on', 10, 0x10),
+])
+
+# State response payload
+STATE = schema('state_record', 15, [
+    flag('power_on', 1, 0x01),
+    # imode_resume 1 & 0x4, timer_mode 1 & 0x10, appliance_error 1 & 0x80
+    bits('temperature', 2, 0, 3),
+    flag('temperature_half', 2, 0x10),
+    bits('operational_mode', 2, 5, 7),
+    # TODO Fan speed can be auto = 102, or value from 0 - 100
+    # On my unit, Low == 40 (LED < 40), Med == 60 (LED < 60), High == 100 (LED < 100)
+    byte('fan_speed', 3),
+    # on/off timers in bytes 4, 5 and 6
+    bits('swing_mode', 7, 0, 3),
+    # cozy_sleep 8 & 0x03, save 8 & 0x08, low_frequency_fan 8 & 0x10, feel_own 8 & 0x80
+    flag('turbo_mode_alt', 8, 0x20),
+    # child_sleep_mode 9 & 0x01, exchange_air 9 & 0x02, dry_clean 9 & 0x04,
+    # aux_heat 9 & 0x08, clean_up 9 & 0x20, temp_unit 9 & 0x80
+    flag('eco_mode', 9, 0x10),
+    # catch_cold 10 & 0x08, night_light 10 & 0x10, peak_elec 10 & 0x20, natural_fan 10 & 0x40
+    flag('sleep', 10, 0x01),
+    flag('turbo_mode', 10, 0x02),
+    flag('fahrenheit', 10, 0x04),
+    byte('indoor_temperature', 11),
+    byte('outdoor_temperature', 12),
+    # humidity 13 & 0x7F
+    byte('display', 14),
+    # TODO dudanov/MideaUART freeze protection in byte 21, bit 7
+    # TODO dudanov/MideaUART humidity set point in byte 19, mask 0x7F
+])
+
 class get_capabilities_command(command):
+    response_ids = (ResponseId.Capabilities,)
+
     def __init__(self, device_type):
         super().__init__(device_type, FRAME_TYPE=FRAME_TYPE.Request)
 
+    @property
+    def payload_key(self):
+        return 'capabilities'
+
     @property
     def payload(self):
         return bytes([
@@ -63,11 +194,17 @@ class get_capabilities_command(command):
         ])
 
 class get_state_command(command):
+    response_ids = (ResponseId.State,)
+
     def __init__(self, device_type):
         super().__init__(device_type, FRAME_TYPE=FRAME_TYPE.Request)
 
         self.temperature_type = temperature_type.Indoor
 
+    @property
+    def payload_key(self):
+        return ('state', self.temperature_type)
+
     @property
     def payload(self):
         return bytes([
@@ -87,6 +224,8 @@ class get_state_command(command):
 
 
 class set_state_command(command):
+    response_ids = (ResponseId.State,)
+
     def __init__(self, device_type):
         super().__init__(device_type, FRAME_TYPE=FRAME_TYPE.Set)
 
@@ -104,57 +243,27 @@ class set_state_command(command):
 
     @property
     def payload(self):
-        # Build prompt tone and power status byte
-        beep = 0x42 if self.beep_on else 0
-        power = 0x1 if self.power_on else 0
-
-        # Build target temp and mode byte
         fractional, integral = math.modf(self.target_temperature)
-        temperature = (int(integral) & 0xF) | (0x10 if fractional > 0 else 0)
-        mode = (self.operational_mode & 0x7) << 5
-
-        # Build swing mode byte
-        swing_mode = 0x30 | (self.swing_mode & 0x3F)
-
-        # Build eco mode byte
-        eco_mode = 0x80 if self.eco_mode else 0
-
-        # Build turbo, display and fahrenheit byte
-        sleep = 0x01 if self.sleep else 0
-        turbo = 0x02 if self.turbo_mode else 0
-        display = 0x10 if self.display_on else 0
-        fahrenheit = 0x04 if self.fahrenheit else 0
-
-        # Build alternate turbo byte
-        turbo_alt = 0x20 if self.turbo_mode else 0
-
-        return bytes([
-            # Set state
-            0x40,
-            # Beep and power state
-            beep | power,
-            # Temperature and operational mode
-            temperature | mode,
-            # Fan speed
-            self.fan_speed,
-            # Unknown
-            0x7F, 0x7F, 0x00,
-            # Swing mode
-            swing_mode,
-            # Alternate turbo mode
-            turbo_alt,
-            # ECO mode
-            eco_mode,
-            # Turbo mode, display on and fahrenheit
-            sleep | turbo | display | fahrenheit,
-            # Unknown
-            0x00, 0x00, 0x00, 0x00,
-            0x00, 0x00, 0x00, 0x00,
-            0x00, 0x00, 0x00, 0x00, 0x00,
-        ])
+        return SET_STATE.pack(
+            beep_on=self.beep_on,
+            power_on=self.power_on,
+            temperature=int(integral),
+            temperature_half=fractional > 0,
+            operational_mode=self.operational_mode,
+            fan_speed=self.fan_speed,
+            swing_mode=self.swing_mode,
+            turbo_mode_alt=self.turbo_mode,
+            eco_mode=self.eco_mode,
+            sleep=self.sleep,
+            turbo_mode=self.turbo_mode,
+            fahrenheit=self.fahrenheit,
+            display_on=self.display_on,
+        )
 
 
 class response():
+    __slots__ = ('_id', 'payload')
+
     def __init__(self, frame: bytes):
         # Build a memoryview of the frame for zero-copy slicing
         frame_mv = memoryview(frame)
@@ -163,8 +272,7 @@ class response():
         calc_checksum = command.checksum(frame_mv[0:-1])
         recv_checkum = frame_mv[-1]
         if recv_checkum != calc_checksum:
-            _LOGGER.error("Frame '{}' failed checksum. Received: 0x{:X}, Expected: 0x{:X}.".format(
-                frame_mv.hex(), recv_checkum, calc_checksum))
+            _LOGGER.error("Frame '{}' failed checksum. Received: 0x{:X}, Expected: 0x{:X}.", lazy_hex(frame_mv), recv_checkum, calc_checksum)
             frame_mv.release()
             return
 
@@ -176,8 +284,7 @@ class response():
         calc_crc = crc8.calculate(payload)
         recv_crc = payload_crc[-1]
         if recv_crc != calc_crc:
-            _LOGGER.error("Payload '{}' failed CRC. Received: 0x{:X}, Expected: 0x{:X}.".format(
-                payload_crc.hex(), recv_crc, calc_crc))
+            _LOGGER.error("Payload '{}' failed CRC. Received: 0x{:X}, Expected: 0x{:X}.", lazy_hex(payload_crc), recv_crc, calc_crc)
             frame_mv.release()
             return
 
@@ -212,6 +319,8 @@ class response():
 
 
 class capabilities_response(response):
+    __slots__ = ('capabilities',)
+
     def __init__(self, frame: bytes):
         super().__init__(frame)
 
@@ -223,76 +332,24 @@ class capabilities_response(response):
             return
 
         _LOGGER.debug(
-            "Capabilities response payload: {}".format(payload.hex()))
+            "Capabilities response payload: {}", lazy_hex(payload))
 
         self.read_capabilities(payload)
 
         _LOGGER.debug(
-            "Supported capabilities: {}".format(self.capabilities))
+            "Supported capabilities: {}", self.capabilities)
+
+    @classmethod
+    def from_capabilities(cls, capabilities: dict):
+        # Response rebuilt from a cached capabilities dict
+        res = cls.__new__(cls)
+        res.capabilities = dict(capabilities)
+        return res
 
     def read_capabilities(self, payload: memoryview):
         # Clear existing capabilities
         self.capabilities = {}
 
-        # Define some local functions to parse capability values
-        def get_bool(v): return v != 0
-        def get_value(w): return lambda v: v == w
-        def get_no_value(w): return lambda v: v != w
-
-        # Define a named tuple that represents a decoder
-        reader = namedtuple("decoder", "name read")
-
-        # Create a map of capability ID to decoders
-        capability_readers = {
-            CapabilityId.IndoorHumidity: reader("indoor_humidity", get_bool),
-            CapabilityId.SilkyCool: reader("silky_cool", get_value(1)),
-            CapabilityId.SmartEye:  reader("smart_eye", get_value(1)),
-            CapabilityId.WindOnMe:  reader("wind_on_me", get_value(1)),
-            CapabilityId.WindOffMe:  reader("wind_off_me", get_value(1)),
-            CapabilityId.ActiveClean:  reader("active_clean", get_value(1)),
-            CapabilityId.OneKeyNoWindOnMe: reader("one_key_no_wind_on_me", get_value(1)),
-            CapabilityId.BreezeControl: reader("breeze_control", get_value(1)),
-            # Fan speed control always seems to return false, even if unit can
-            CapabilityId.FanSpeedControl: reader("fan_speed_control", get_no_value(1)),
-            CapabilityId.PresetEco: [
-                reader("eco_mode", get_value(1)),
-                reader("eco_mode_2", get_value(2)),
-            ],
-            CapabilityId.PresetFreezeProtection: reader("freeze_protection", get_value(1)),
-            CapabilityId.Modes: [
-                reader("heat_mode", lambda v: v == 1 or v == 2),
-                reader("cool_mode", lambda v: v == 0 or v == 3),
-                reader("dry_mode", lambda v: v < 2),
-                reader("auto_mode", lambda v: v < 3),
-            ],
-            CapabilityId.SwingModes: [
-                reader("swing_horizontal", lambda v: v == 1 or v == 3),
-                reader("swing_vertical", lambda v: v < 2),
-            ],
-            CapabilityId.Power: [
-                reader("power_cal", lambda v: v == 2 or v == 3),
-                reader("power_cal_setting", lambda v: v == 3),
-            ],
-            CapabilityId.Nest: [
-                reader("nest_check", lambda v: v == 1 or v == 2 or v == 4),
-                reader("nest_need_change", lambda v: v == 3 or v == 4),
-            ],
-            CapabilityId.AuxElectricHeat: reader("aux_electric_heat", get_bool),
-            CapabilityId.PresetTurbo:  [
-                reader("turbo_heat", lambda v: v == 1 or v == 3),
-                reader("turbo_cool", lambda v: v < 2),
-            ],
-            CapabilityId.Humidity:
-            [
-                reader("humidity_auto_set", lambda v: v == 1 or v == 2),
-                reader("humidity_manual_set", lambda v: v == 2 or v == 3),
-            ],
-            CapabilityId.UnitChangeable: reader("unit_changeable", get_value(0)),
-            CapabilityId.LightControl: reader("light_control", get_bool),
-            # Temperatures capability too complex to be handled here
-            CapabilityId.Buzzer:  reader("buzzer", get_bool),
-        }
-
         count = payload[1]
         caps = payload[2:]
 
@@ -307,36 +364,18 @@ class capabilities_response(response):
             if size == 0:
                 continue
 
-            # Covert ID to enumerate type
-            try:
-                # Unpack 16 bit ID
-                (cap_id, ) = struct.unpack("<H", caps[0:2])
-                id = CapabilityId(cap_id)
-            except ValueError:
-                _LOGGER.warn(
-                    "Unknown capability. ID: 0x{:04X}, Size: {}.".format(id, size))
-                # Advanced to next capability
-                caps = caps[3+size:]
-                continue
-
-            # Fetch first cap value
-            value = caps[3]
+            # Unpack 16 bit ID
+            cap_id = caps[0] | caps[1] << 8
 
             # Apply predefined capability reader if it exists
-            if id in capability_readers:
-                # Local function to apply a reader
-                def apply(d): return {d.name: d.read(value)}
-
-                reader = capability_readers[cap_id]
-                if isinstance(reader, list):
-                    # Apply each reader in the list
-                    for r in reader:
-                        self.capabilities.update(apply(r))
-                else:
-                    # Apply the single reader
-                    self.capabilities.update(apply(reader))
-
-            elif id == CapabilityId.Temperatures:
+            readers = CAPABILITY_READERS[cap_id] if cap_id < len(CAPABILITY_READERS) else None
+            if readers is not None:
+                # Fetch first cap value
+                value = caps[3]
+                for name, read in readers:
+                    self.capabilities[name] = read(value)
+
+            elif cap_id == CapabilityId.Temperatures:
                 # Skip if capability size is too small
                 if size < 6:
                     continue
@@ -350,9 +389,12 @@ class capabilities_response(response):
 
                 self.capabilities["decimals"] = caps[9] == 0 if size > 6 else caps[2] == 0
 
+            elif cap_id in CapabilityId._value2member_map_:
+                _LOGGER.throttled_warning(
+                    "Unsupported capability. ID: 0x{:04X}, Size: {}.", cap_id, size)
             else:
-                _LOGGER.warn(
-                    "Unsupported capability. ID: 0x{:04X}, Size: {}.".format(id, size))
+                _LOGGER.throttled_warning(
+                    "Unknown capability. ID: 0x{:04X}, Size: {}.", cap_id, size)
 
             # Advanced to next capability
             caps = caps[3+size:]
@@ -394,6 +436,11 @@ class capabilities_response(response):
         return self.capabilities.get("turbo_heat", False) or self.capabilities.get("turbo_cool", False)
 
 class state_response(response):
+    # Slots keep the many responses of a busy poller small
+    __slots__ = ('power_on', 'target_temperature', 'operational_mode', 'fan_speed', 'swing_mode',
+                 'turbo_mode', 'eco_mode', 'sleep', 'fahrenheit', 'indoor_temperature',
+                 'outdoor_temperature', 'display_on')
+
     def __init__(self, frame: bytes):
         super().__init__(frame)
 
@@ -405,26 +452,20 @@ class state_response(response):
             return
 
         _LOGGER.debug(
-            "State response payload: {}".format(payload.hex()))
+            "State response payload: {}", lazy_hex(payload))
 
         self.read_state(payload)
 
     def read_state(self, payload: memoryview):
+        state = STATE.unpack(payload)
 
-        self.power_on = bool(payload[1] & 0x1)
-        #self.imode_resume = payload[1] & 0x4
-        #self.timer_mode = (payload[1] & 0x10) > 0
-        #self.appliance_error = (payload[1] & 0x80) > 0
+        self.power_on = state.power_on
 
-        # Unpack target temp and mode byte
-        self.target_temperature = (payload[2] & 0xF) + 16.0
-        self.target_temperature += 0.5 if payload[2] & 0x10 else 0.0
-        self.operational_mode = (payload[2] >> 5) & 0x7
+        self.target_temperature = state.temperature + 16.0
+        self.target_temperature += 0.5 if state.temperature_half else 0.0
+        self.operational_mode = state.operational_mode
 
-        # Fan speed
-        # TODO Fan speed can be auto = 102, or value from 0 - 100
-        # On my unit, Low == 40 (LED < 40), Med == 60 (LED < 60), High == 100 (LED < 100)
-        self.fan_speed = payload[3]
+        self.fan_speed = state.fan_speed
 
         # on_timer_value = payload[4]
         # on_timer_minutes = payload[6]
@@ -442,38 +483,14 @@ class state_response(response):
         #     'minutes': (off_timer_value & 0x3) | (off_timer_minutes & 0xf)
         # }
 
-        # Swing mode
-        self.swing_mode = payload[7] & 0xF
-
-        # self.cozy_sleep = payload[8] & 0x03
-        # self.save = (payload[8] & 0x08) > 0
-        # self.low_frequency_fan = (payload[8] & 0x10) > 0
-        self.turbo_mode = bool(payload[8] & 0x20)
-        # self.feel_own = (payload[8] & 0x80) > 0
-
-        self.eco_mode = bool(payload[9] & 0x10)
-        # self.child_sleep_mode = (payload[9] & 0x01) > 0
-        # self.exchange_air = (payload[9] & 0x02) > 0
-        # self.dry_clean = (payload[9] & 0x04) > 0
-        # self.aux_heat = (payload[9] & 0x08) > 0
-        # self.clean_up = (payload[9] & 0x20) > 0
-        # self.temp_unit = (payload[9] & 0x80) > 0
-
-        self.sleep = bool(payload[10] & 0x1)
-        self.turbo_mode |= bool(payload[10] & 0x2)
-        self.fahrenheit = bool(payload[10] & 0x4)
-        # self.catch_cold = (payload[10] & 0x08) > 0
-        # self.night_light = (payload[10] & 0x10) > 0
-        # self.peak_elec = (payload[10] & 0x20) > 0
-        # self.natural_fan = (payload[10] & 0x40) > 0
-
-        self.indoor_temperature = (payload[11] - 50) / 2.0
-
-        self.outdoor_temperature = (payload[12] - 50) / 2.0
+        self.swing_mode = state.swing_mode
 
-        # self.humidity = (payload[13] & 0x7F)
+        self.turbo_mode = state.turbo_mode or state.turbo_mode_alt
+        self.eco_mode = state.eco_mode
+        self.sleep = state.sleep
+        self.fahrenheit = state.fahrenheit
 
-        self.display_on = (payload[14] != 0x70)
+        self.indoor_temperature = (state.indoor_temperature - 50) / 2.0
+        self.outdoor_temperature = (state.outdoor_temperature - 50) / 2.0
 
-        # TODO dudanov/MideaUART freeze protection in byte 21, bit 7
-        # TODO dudanov/MideaUART humidity set point in byte 19, mask 0x7F
+        self.display_on = (state.display != 0x70)
@@ -1,13 +1,21 @@
 
-import logging
 import time
 from enum import Enum
 from .command import get_state_command, appliance_response
 from msmart.device.base import device
+from msmart.log import get_logger
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
+
+# Seconds between polls by machine status
+IDLE_POLL_INTERVAL = 600
+PAUSE_POLL_INTERVAL = 120
+DELAY_POLL_INTERVAL = 900
+# A running cycle is polled four times over its remaining time, within these
+MIN_POLL_INTERVAL = 10
+RUNNING_POLL_INTERVAL = 300
 
 
 class front_load_washer(device):
@@ -39,10 +47,11 @@ class front_load_washer(device):
 
         @staticmethod
         def get(value):
-            if(value in front_load_washer.cycle_program_enum._value2member_map_):
-                return front_load_washer.cycle_program_enum(value)
-            _LOGGER.debug("Unknown cycle_program: {}".format(value))
-            return front_load_washer.cycle_program_enum.UNKNOWN
+            member = front_load_washer.cycle_program_enum._value2member_map_.get(value)
+            if member is None:
+                _LOGGER.debug("Unknown cycle_program: {}", value)
+                return front_load_washer.cycle_program_enum.UNKNOWN
+            return member
 
     class machine_status_enum(Enum):
         UNKNOWN = 255
@@ -60,10 +69,15 @@ class front_load_washer(device):
 
         @staticmethod
         def get(value):
-            if(value in front_load_washer.machine_status_enum._value2member_map_):
-                return front_load_washer.machine_status_enum(value)
-            _LOGGER.debug("Unknown machine_status: {}".format(value))
-            return front_load_washer.machine_status_enum.Unknown    
+            member = front_load_washer.machine_status_enum._value2member_map_.get(value)
+            if member is None:
+                _LOGGER.debug("Unknown machine_status: {}", value)
+                return front_load_washer.machine_status_enum.UNKNOWN
+            return member
+
+    _state_fields = ('power', 'machine_status', 'work_mode', 'cycle_program', 'water_line', 'dring_state',
+                     'rinse_times', 'temperature', 'dehydrate_speed', 'wash_times', 'dehydrate_time',
+                     'wash_dose', 'memory', 'supple_dose', 'remainder_time', 'wash_experts')
 
     def __init__(self, *args, **kwargs):
         super(front_load_washer, self).__init__(*args, **kwargs)
@@ -83,6 +97,8 @@ class front_load_washer(device):
         self._memory = 0
         self._supple_dose  = 0
         self._remainder_time = 0
+        self._remainder_time_at = None
+        self._wash_experts = 0
         self._appliance_type = 0xff
 
         self._on_timer = None
@@ -93,26 +109,44 @@ class front_load_washer(device):
     def __str__(self):
         return str(self.__dict__)
 
+    def _state_command(self):
+        return get_state_command(self.type)
+
     def refresh(self):
-        cmd = get_state_command(self.type)
+        cmd = self._state_command()
         self._send_cmd(cmd)
+
+    async def async_refresh(self):
+        cmd = self._state_command()
+        await self._async_send_cmd(cmd)
     
     def _send_cmd(self, cmd):
         responses = self.send_cmd(cmd)
         for response in responses:
             self._process_response(response)
 
+    async def _async_send_cmd(self, cmd):
+        responses = await self.async_send_cmd(cmd)
+        for response in responses:
+            self._process_response(response)
+
     def _process_response(self, data):
         if self.process_response(data):
-            response = appliance_response(data)
             self._defer_update = False
             self._support = True
-            self.update(response)
+            if self._unchanged(data):
+                return
+            response = appliance_response(data)
+            self._apply_update(self.update, data, response)
 
     def update(self, res: appliance_response):   
         if res.update:     
+            machine_status = front_load_washer.machine_status_enum.get(res.machine_status)
+            # The remaining minutes count down from when they last changed
+            if res.remainder_time != self._remainder_time or machine_status != self._machine_status:
+                self._remainder_time_at = time.time()
             self._power = res.power
-            self._machine_status = front_load_washer.machine_status_enum.get(res.machine_status)
+            self._machine_status = machine_status
             self._work_mode = res.work_mode
             self._cycle_program = front_load_washer.cycle_program_enum.get(res.cycle_program)
             self._water_line = res.water_line
@@ -132,6 +166,33 @@ class front_load_washer(device):
             # self._on_timer = res.on_timer
             # self._off_timer = res.off_timer
 
+    def poll_interval(self):
+        status = self._machine_status
+        if status == front_load_washer.machine_status_enum.START:
+            return min(max(self.remaining_seconds / 4, MIN_POLL_INTERVAL), RUNNING_POLL_INTERVAL)
+        if status == front_load_washer.machine_status_enum.DELAY:
+            return min(max(self.remaining_seconds / 4, MIN_POLL_INTERVAL), DELAY_POLL_INTERVAL)
+        if status == front_load_washer.machine_status_enum.PAUSE:
+            return PAUSE_POLL_INTERVAL
+        return IDLE_POLL_INTERVAL
+
+    @property
+    def remaining_seconds(self):
+        # remainder_time is in minutes and is only read now and then
+        remaining = self._remainder_time * 60
+        if self._remainder_time_at is None or self._machine_status == front_load_washer.machine_status_enum.PAUSE:
+            return remaining
+        return max(0, remaining - (time.time() - self._remainder_time_at))
+
+    @property
+    def eta(self):
+        '''Estimated end of the cycle as a time.time() timestamp, None when no cycle is running.'''
+        if self._machine_status not in (front_load_washer.machine_status_enum.START,
+                                        front_load_washer.machine_status_enum.DELAY,
+                                        front_load_washer.machine_status_enum.PAUSE):
+            return None
+        return time.time() + self.remaining_seconds
+
 
     @property
     def power(self):
@@ -1,18 +1,47 @@
 
-import logging
 from enum import IntEnum
-from msmart.utils import getBit, getBits
 from msmart.const import FRAME_TYPE
 from msmart.base_command import command as base_command
+from msmart.log import get_logger, lazy_hex
+from msmart.schema import bits, byte, flag, schema, u16
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
+
+# Appliance response payload, decoded once per response
+STATE = schema('appliance_record', 24, [
+    flag('power', 1, 0x01),
+    byte('machine_status', 2),
+    byte('work_mode', 3),
+    byte('cycle_program', 4),
+    byte('water_line', 5),
+    bits('dring_state', 6, 0, 3),
+    bits('rinse_times', 6, 4, 7),
+    byte('temperature', 7),
+    byte('dehydrate_speed', 8),
+    byte('wash_times', 9),
+    byte('dehydrate_time', 10),
+    byte('wash_dose', 11),
+    byte('memory', 12),
+    byte('supple_dose', 13),
+    u16('remainder_time', 17),
+    byte('wash_experts', 19),
+    # Only in replies to set commands
+    byte('appliance_type', 20),
+    byte('code_0', 21),
+    byte('code_1', 22),
+    byte('code_2', 23),
+])
 
 class get_state_command(base_command):
     def __init__(self, device_type=0xdb, FRAME_TYPE=FRAME_TYPE.Request):
         super().__init__(device_type, FRAME_TYPE)
 
+    @property
+    def payload_key(self):
+        return 'state'
+
     @property
     def payload(self):
         return bytes([
@@ -21,6 +50,7 @@ class get_state_command(base_command):
         ])
 
 class appliance_response:
+    __slots__ = ('header', 'data', 'message_type', 'update', 'state')
 
     def __init__(self, data: bytearray):
         self.header = data[:0xa]
@@ -29,79 +59,80 @@ class appliance_response:
         self.update = True
         if self.message_type == FRAME_TYPE.Report and self.data[0] !=  FRAME_TYPE.Report:
             self.update = False
-        _LOGGER.info("Appliance response type: {} update:{} data: {}".format(self.message_type, self.update, self.data.hex()))
+        self.state = STATE.unpack(self.data)
+        _LOGGER.debug("Appliance response type: {} update:{} data: {}", self.message_type, self.update, lazy_hex(self.data))
 
     # Byte 0x01
     @property
     def power(self):
-        return (self.data[1] & 0x1) > 0
+        return self.state.power
 
     @property
     def machine_status(self):
-        return self.data[2]
+        return self.state.machine_status
 
     @property
     def work_mode(self):
-        return self.data[3]
+        return self.state.work_mode
     
     @property
     def cycle_program(self):
-        return self.data[4]
+        return self.state.cycle_program
     
     @property
     def water_line (self):
-        return self.data[5]
+        return self.state.water_line
 
     @property
     def dring_state(self):
-        return getBits(self.data, 6, 0, 3)
+        return self.state.dring_state
 
     @property
     def rinse_times(self):
-        return getBits(self.data, 6, 4, 7)
+        return self.state.rinse_times
     
     @property
     def temperature(self):
-        return self.data[7]
+        return self.state.temperature
     
     @property
     def dehydrate_speed(self):
-        return self.data[8]
+        return self.state.dehydrate_speed
     
     @property
     def wash_times(self):
-        return self.data[9]
+        return self.state.wash_times
     
     @property
     def dehydrate_time(self):
-        return self.data[10]
+        return self.state.dehydrate_time
 
     @property
     def wash_dose(self):
-        return self.data[11]
+        return self.state.wash_dose
 
     @property
     def memory(self):
-        return self.data[12]
+        return self.state.memory
     
     @property
     def supple_dose(self):
-        return self.data[13]
+        return self.state.supple_dose
 
     @property
     def remainder_time(self):
-        return self.data[17] | self.data[18] << 8
+        return self.state.remainder_time
     
     @property
     def wash_experts(self):
-        return self.data[19]
+        return self.state.wash_experts
 
     @property
     def appliance_type(self):
         if self.message_type == FRAME_TYPE.Set:
-            return self.data[20]
+            return self.state.appliance_type
     
     @property
     def appliance_code(self):
         if self.message_type ==  FRAME_TYPE.Set:
-            return chr(self.data[23]) + chr(self.data[22]) + chr(self.data[21])
\ No newline at end of file
+            return chr(self.state.code_2) + chr(self.state.code_1) + chr(self.state.code_0)
\ No newline at end of file
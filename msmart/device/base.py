@@ -1,20 +1,36 @@
 
-import logging
-from msmart.lan import lan
+import asyncio
+from msmart.circuit_breaker import circuit_breaker
+from msmart.const import FRAME_TYPE
+from msmart.lan import LISTEN_TIMEOUT
+from msmart.log import get_logger, lazy_hex
 from msmart.packet_builder import packet_builder
+from msmart.pool import default_pool
+from msmart.store import default_session_store
+import threading
 import time
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 
+# Pause before reconnecting a listener that lost its connection
+LISTEN_RETRY = 5
+# Seconds between refreshes in poll() for devices without a polling policy
+POLL_INTERVAL = 30
 
 
 class device:
-    
+    # Properties a state update can change, compared to find changed_fields
+    _state_fields = ()
+
     def __init__(self, device_ip: str, device_id: int, device_port: int):
         self._name = None
-        self._lan_service = lan(device_ip, device_id, device_port)
+        self._ssid = None
+        self._model = None
+        self._sn = None
+        self._lan_service = default_pool.acquire(device_ip, device_id, device_port)
+        self._async_lan_service = None
         self._ip = device_ip
         self._id = device_id
         self._port = device_port
@@ -30,21 +46,78 @@ class device:
         self._token = None
         self._key = None
         self._last_responses = []
+        self._last_poll = 0
+        # Per device message ids
+        self._message_id = 0
+        self._message_lock = threading.Lock()
+        self._subscribers = []
+        # Last decoded payload and resulting state per (frame type, response id)
+        self._last_payloads = {}
+        self._changed_fields = set()
+        self._packet_builder = packet_builder(device_id)
         
-    def authenticate(self, key: str, token: str):
+    def authenticate(self, key: str = None, token: str = None):
+        # Without a key pair, fall back to the stored one
+        if key is None or token is None:
+            key, token = self._stored_key_token()
+            if key is None:
+                return False
         # compatible example.py
         if key != "YOUR_AC_K1" and token != "YOUR_AC_TOKEN":
             self._protocol_version = 3
             self._token = bytearray.fromhex(token)
             self._key = bytearray.fromhex(key)
-            return self._authenticate()
+            success = self._authenticate()
+            if success:
+                self._store_key_token(key, token)
+            return success
         return False
         
     def _authenticate(self):
-        return self._lan_service.authenticate(self._token, self._key)
+        self._lan_service.set_token_key(self._token, self._key)
+        return self._lan_service.open_session()
+
+    async def async_authenticate(self, key: str = None, token: str = None):
+        if key is None or token is None:
+            key, token = self._stored_key_token()
+            if key is None:
+                return False
+        # compatible example.py
+        if key != "YOUR_AC_K1" and token != "YOUR_AC_TOKEN":
+            self._protocol_version = 3
+            self._token = bytearray.fromhex(token)
+            self._key = bytearray.fromhex(key)
+            lan_service = self._get_async_lan_service()
+            lan_service.set_token_key(self._token, self._key)
+            success = await lan_service.open_session()
+            if success:
+                self._store_key_token(key, token)
+            return success
+        return False
+
+    def _stored_key_token(self):
+        store = default_session_store()
+        if store is None:
+            return None, None
+        token, key = store.get_token_key(self.id)
+        return key, token
+
+    def _store_key_token(self, key, token):
+        store = default_session_store()
+        if store is not None:
+            store.set_token_key(self.id, token, key)
+
+    def _get_async_lan_service(self):
+        # Acquired from the event loop on first use
+        if self._async_lan_service is None:
+            self._async_lan_service = default_pool.acquire_async(self._ip, self._id, self._port)
+            self._async_lan_service.set_token_key(self._token, self._key)
+            self._async_lan_service.protocol.model = self._model
+        return self._async_lan_service
 
     def set_device_detail(self, device_detail: dict):
         '''set device detail'''
+        address = (self._ip, self._port, self._id)
         self._ip = device_detail.get('host', self._ip)
         self._port = device_detail.get('port', 6444)
         self._id = device_detail.get('id', self._id)
@@ -55,59 +128,246 @@ class device:
         self._type = device_detail.get('type', self._type)
         self._protocol_version = device_detail.get('version', self._protocol_version)
 
-        self._lan_service = lan(self._ip, self._id, self._port)
-        self._lan_service._key = self._key
-        self._lan_service._token = self._token
+        # Same (ip, port, id) keeps the pooled sockets and tcp_key, a new
+        # address releases the old sessions
+        lan_service = default_pool.acquire(self._ip, self._id, self._port)
+        default_pool.release(self._lan_service)
+        self._lan_service = lan_service
+        self._lan_service.set_token_key(self._token, self._key)
+        if self._async_lan_service is not None:
+            if address == (self._ip, self._port, self._id):
+                self._async_lan_service.set_token_key(self._token, self._key)
+            else:
+                default_pool.release_async(self._async_lan_service)
+                self._async_lan_service = None
 
         self._name = device_detail.get('name', self._name)
         self._ssid = device_detail.get('ssid', None)
         self._model = device_detail.get('model', None)
         self._sn = device_detail.get('sn', None)
+        self._lan_service.protocol.model = self._model
+        if self._async_lan_service is not None:
+            self._async_lan_service.protocol.model = self._model
+        self._packet_builder = packet_builder(self._id)
         
 
+    def close(self):
+        '''Release the pooled sessions, the device is not used afterwards.'''
+        if self._lan_service is not None:
+            default_pool.release(self._lan_service)
+            self._lan_service = None
+        if self._async_lan_service is not None:
+            default_pool.release_async(self._async_lan_service)
+            self._async_lan_service = None
+
+    def _state_command(self):
+        # Command refresh() sends, None if the device has none
+        return None
+
     def refresh(self):
         pass
 
     def apply(self):
         pass
 
-    def send_cmd(self, cmd):
-        pkt_builder = packet_builder(self.id)
-        pkt_builder.set_command(cmd)
-        data = pkt_builder.finalize()
+    async def async_refresh(self):
+        pass
+
+    async def async_apply(self):
+        pass
+
+    def _build_packet(self, cmd):
+        # Valid until the next packet of the same size on this thread
+        data = self._packet_builder.build(cmd)
         _LOGGER.debug(
-            "pkt_builder: {}:{} len: {} data: {}".format(self.ip, self.port, len(data), data.hex()))
+            "pkt_builder: {}:{} len: {} data: {}", self.ip, self.port, len(data), lazy_hex(data))
+        return data
+
+    def send_cmd(self, cmd):
+        # Commands from other callers may share the write, the reply is
+        # picked out by cmd.matches()
+        return self.send_batch([cmd])
+
+    async def async_send_cmd(self, cmd):
+        return await self.async_send_batch([cmd])
+
+    def send_batch(self, cmds):
+        '''
+        Send several commands in one write and return the replies to all of
+        them, so a device is queried in a single round trip.
+        '''
+        packets = self._build_packets(cmds)
+        if cmds[-1].FRAME_TYPE == FRAME_TYPE.Request:
+            # Replay queries to keep the pooled connection alive
+            self._lan_service.keepalive_data = packets[-1]
         send_time = time.time()
-        if self._protocol_version == 3:
-            responses = self._lan_service.appliance_transparent_send_8370(data)
-        else:
-            responses = self._lan_service.appliance_transparent_send(data)
-        request_time = round(time.time() - send_time, 2)
+        replies = self._lan_service.submit(packets, [cmd.matches for cmd in cmds], self._protocol_version == 3)
+        return self._handle_responses([packet for reply in replies for packet in reply], send_time)
+
+    async def async_send_batch(self, cmds):
+        packets = self._build_packets(cmds)
+        lan_service = self._get_async_lan_service()
+        if cmds[-1].FRAME_TYPE == FRAME_TYPE.Request:
+            lan_service.keepalive_data = packets[-1]
+        send_time = time.time()
+        replies = await lan_service.submit(packets, [cmd.matches for cmd in cmds], self._protocol_version == 3)
+        return self._handle_responses([packet for reply in replies for packet in reply], send_time)
+
+    def _build_packets(self, cmds):
+        packets = []
+        for cmd in cmds:
+            self._assign_message_id(cmd)
+            # Packets of the same size share a buffer
+            packets.append(bytes(self._build_packet(cmd)))
+        return packets
+
+    def subscribe(self, callback):
+        '''
+        Call callback(device) whenever a pushed report changes the device,
+        device.changed_fields names what changed.
+        '''
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def poll_interval(self):
+        # Seconds until the state is worth reading again, None when every
+        # round should query the device
+        return None
+
+    def poll_due(self, now=None):
+        interval = self.poll_interval()
+        if interval is None:
+            return True
+        return (now or time.time()) >= self._last_poll + interval
+
+    def poll(self, stop: threading.Event = None):
+        '''
+        Refresh as often as poll_interval() asks, until stop is set.
+        Blocks, run it in its own thread.
+        '''
+        if stop is None:
+            stop = threading.Event()
+        while not stop.is_set():
+            self.refresh()
+            stop.wait(self.poll_interval() or POLL_INTERVAL)
+
+    async def async_poll(self):
+        '''asyncio version of poll(), runs until cancelled.'''
+        while True:
+            await self.async_refresh()
+            await asyncio.sleep(self.poll_interval() or POLL_INTERVAL)
+
+    def listen(self, stop: threading.Event = None, timeout=LISTEN_TIMEOUT):
+        '''
+        Keep the connection open and apply Report and ABNL_REPORT frames as
+        they arrive, until stop is set. Blocks, run it in its own thread.
+        '''
+        if stop is None:
+            stop = threading.Event()
+        while not stop.is_set():
+            if self._protocol_version == 3 and not self._lan_service.open_session():
+                stop.wait(LISTEN_RETRY)
+                continue
+            packets = self._lan_service.receive(timeout)
+            if packets is None:
+                stop.wait(LISTEN_RETRY)
+                continue
+            self._process_reports(packets)
+
+    async def async_listen(self, timeout=LISTEN_TIMEOUT):
+        '''asyncio version of listen(), runs until cancelled.'''
+        lan_service = self._get_async_lan_service()
+        while True:
+            if self._protocol_version == 3 and not await lan_service.open_session():
+                await asyncio.sleep(LISTEN_RETRY)
+                continue
+            packets = await lan_service.receive(timeout)
+            if packets is None:
+                await asyncio.sleep(LISTEN_RETRY)
+                continue
+            self._process_reports(packets)
+
+    def _process_reports(self, packets):
+        self._changed_fields = set()
+        for packet in packets:
+            if len(packet) < 10 or packet[9] not in (FRAME_TYPE.Report, FRAME_TYPE.ABNL_REPORT):
+                # Late replies to requests that already timed out
+                _LOGGER.debug("Unsolicited frame from {}:{} {}", self.ip, self.port, lazy_hex(packet))
+            self._process_response(packet)
+        if self._changed_fields:
+            for callback in list(self._subscribers):
+                try:
+                    callback(self)
+                except Exception:
+                    _LOGGER.exception("Subscriber callback failed for {}:{}", self.ip, self.port)
+
+    def _process_response(self, data):
+        pass
+
+    def _snapshot(self):
+        return tuple(getattr(self, name) for name in self._state_fields)
+
+    def _unchanged(self, data):
+        # The payload repeats the last decoded one, without the message id,
+        # CRC and checksum, and nothing was changed locally since
+        if len(data) < 13:
+            return False
+        last = self._last_payloads.get((data[9], data[10]))
+        return last is not None and last[0] == data[10:-3] and last[1] == self._snapshot()
+
+    def _apply_update(self, update, data, response):
+        # Run update(response) and record which state fields it changed
+        before = self._snapshot()
+        update(response)
+        after = self._snapshot()
+        if len(data) >= 13:
+            self._last_payloads[(data[9], data[10])] = (bytes(data[10:-3]), after)
+        self._changed_fields.update(
+            name for name, old, new in zip(self._state_fields, before, after) if old != new)
+
+    def _assign_message_id(self, cmd):
+        with self._message_lock:
+            self._message_id = (self._message_id + 1) & 0xFF
+            cmd.message_id = self._message_id
+
+    def _handle_responses(self, responses, send_time):
+        self._last_poll = time.time()
+        request_time = round(self._last_poll - send_time, 2)
         _LOGGER.debug(
-            "Got responses from {}:{} Version: {} Count: {} Spend time: {}".format(self.ip, self.port, self._protocol_version, len(responses), request_time))
+            "Got responses from {}:{} Version: {} Count: {} Spend time: {}", self.ip, self.port, self._protocol_version, len(responses), request_time)
         if len(responses) == 0:
-            _LOGGER.warn(
-                "Got Null from {}:{} Version: {} Count: {} Spend time: {}".format(self.ip, self.port, self._protocol_version, len(responses), request_time))
+            _LOGGER.warning(
+                "Got Null from {}:{} Version: {} Count: {} Spend time: {}", self.ip, self.port, self._protocol_version, len(responses), request_time)
             self._active = False
             self._support = False
         # sort, put CMD_TYPE_QUERRY last, so we can get END(machine_status) from the last response
         responses.sort()
         self._last_responses = responses
+        self._changed_fields = set()
         return responses
     
     def process_response(self, data):
         _LOGGER.debug(
-            "Update from {}:{} {}".format(self.ip, self.port, data.hex()))
+            "Update from {}:{} {}", self.ip, self.port, lazy_hex(data))
         if len(data) > 0:
             self._online = True
             self._active = True
             if data == b'ERROR':
                 self._support = False
-                _LOGGER.warn(
-                    "Got ERROR from {}, {}".format(self.ip, self.id))
+                _LOGGER.warning(
+                    "Got ERROR from {}, {}", self.ip, self.id)
                 return
             return data
 
+    @property
+    def changed_fields(self):
+        '''Names of the properties changed by the last refresh or pushed reports.'''
+        return self._changed_fields
+
     @property
     def id(self):
         return self._id
@@ -146,12 +406,18 @@ class device:
 
     @property
     def active(self):
-        return self._active
+        return self._active and self.circuit_state == circuit_breaker.state_enum.CLOSED
 
     @property
     def online(self):
+        if self.circuit_state == circuit_breaker.state_enum.OPEN and not self._keep_last_known_online_state:
+            return False
         return self._online
 
+    @property
+    def circuit_state(self):
+        return self._lan_service.breaker.state
+
     @property
     def support(self):
         return self._support
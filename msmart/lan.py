@@ -1,197 +1,297 @@
 # -*- coding: UTF-8 -*-
-import logging
+import select
 import socket
+import threading
 import time
-from msmart.const import MSGTYPE_ENCRYPTED_REQUEST, MSGTYPE_HANDSHAKE_REQUEST
-from msmart.security import security
+from msmart.circuit_breaker import circuit_breaker
+from msmart.const import MSGTYPE_ENCRYPTED_REQUEST
+from msmart.lan_protocol import CLOSE, OPEN, SLEEP, lan_protocol, pending_request
+from msmart.log import get_logger, lazy, lazy_hex
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
+
+# How long receive() waits for unsolicited frames
+LISTEN_TIMEOUT = 1
 
 
 class lan:
+    '''Blocking socket transport, the session state lives in self.protocol.'''
+
     def __init__(self, device_ip, device_id, device_port=6444):
         self.device_ip = device_ip
         self.device_id = device_id
         self.device_port = device_port
-        self.security = security()
-        self._retries = 0
+        self.protocol = lan_protocol(device_ip, device_id, device_port)
         self._socket = None
-        self._token = None
-        self._key = None
-        self._timestamp = time.time()
-        self._tcp_key = None
-        self._local = None
-        self._remote = device_ip + ":" + str(device_port)
+        self._lock = threading.RLock()
+        # Requests queued for the next write, see submit()
+        self._inflight = []
+        self._inflight_lock = threading.Lock()
+        # Request replayed by keepalive(), set by the owning device
+        self.keepalive_data = None
 
     def _connect(self):
         if self._socket is None:
             self._disconnect()
-            _LOGGER.debug("Attempting new connection to {}:{}".format(
-                self.device_ip, self.device_port))
-            self._buffer = b''
+            _LOGGER.debug("Attempting new connection to {}:{}", self.device_ip, self.device_port)
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # set timeout
-            self._socket.settimeout(2)
+            self._socket.settimeout(self.protocol.timeout)
             try:
                 self._socket.connect((self.device_ip, self.device_port))
-                self._timestamp = time.time()
-                self._local = ":".join(
-                    '%s' % i for i in self._socket.getsockname())
+                self.protocol.connection_made(":".join(
+                    '%s' % i for i in self._socket.getsockname()))
             except Exception as error:
-                _LOGGER.error("Connect Error: {}:{} {}".format(
-                    self.device_ip, self.device_port, error))
+                _LOGGER.error("Connect Error: {}:{} {}", self.device_ip, self.device_port, error)
                 self._disconnect()
 
     def _disconnect(self):
         if self._socket:
             self._socket.close()
             self._socket = None
-            self._tcp_key = None
-    
+            self.protocol.connection_lost()
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    @property
+    def breaker(self):
+        return self.protocol.breaker
+
+    @property
+    def last_request(self):
+        return self.protocol.last_request
+
+    @property
+    def last_activity(self):
+        return self.protocol.last_activity
+
     def get_socket_info(self):
-        socket_time = round(time.time() - self._timestamp, 2)
-        return "{} -> {} retries: {} time: {}".format(self._local, self._remote, self._retries, socket_time)
+        return self.protocol.get_socket_info()
+
+    def set_token_key(self, token, key):
+        with self._lock:
+            if self.protocol.set_token_key(token, key):
+                self._disconnect()
+
+    def open_session(self):
+        # Reuse the live session, else resume a stored one or handshake
+        with self._lock:
+            return self._open_session()
+
+    def _open_session(self):
+        if self._socket is not None and self.protocol._tcp_key is not None:
+            return True
+        _LOGGER.debug(
+            "Socket {} invalid, Create New Socket and Get New tcp_key {}", lazy(self.get_socket_info), self.protocol._tcp_key)
+        self._disconnect()
+        return self._authenticate()
+
+    def keepalive(self):
+        with self._lock:
+            if not self.connected or self.keepalive_data is None:
+                return False
+            if self.breaker.state != circuit_breaker.state_enum.CLOSED:
+                return False
+            _LOGGER.debug("Keepalive {}", lazy(self.get_socket_info))
+            if self.protocol._tcp_key is not None:
+                packets = self._run(self.protocol.transparent_send_8370(self.keepalive_data))
+            else:
+                packets = self._run(self.protocol.transparent_send(self.keepalive_data))
+            return len(packets) > 0
+
+    def receive(self, timeout=LISTEN_TIMEOUT):
+        '''
+        Wait for frames the device sends on its own, without sending a request.
+        Returns the decoded packets, [] on timeout and None once the connection is lost.
+        '''
+        with self._lock:
+            self._connect()
+            sock = self._socket
+        if sock is None:
+            return None
+        # Wait outside the lock so requests are not held up by the listener
+        try:
+            readable, _, _ = select.select([sock], [], [], timeout)
+        except (OSError, ValueError):
+            return None
+        if not readable:
+            return []
+        with self._lock:
+            if self._socket is not sock:
+                return []
+            # A request may have read the data while we waited for the lock
+            if not select.select([sock], [], [], 0)[0]:
+                return []
+            try:
+                response = sock.recv(1024)
+            except socket.error as error:
+                _LOGGER.debug("Recv {} Error: {}", lazy(self.get_socket_info), error)
+                self._disconnect()
+                return None
+            if len(response) == 0:
+                _LOGGER.debug("Recv {} Server Closed Socket", lazy(self.get_socket_info))
+                self._disconnect()
+                return None
+            return self.protocol.decode(self.protocol.received(response))
 
     def request(self, message):
+        frames, b = self.request_frames(message)
+        return bytearray(b''.join(frames)), b
+
+    def request_frames(self, message, timeout=None, sample=True, expected=1):
+        protocol = self.protocol
+        if timeout is None:
+            timeout = protocol.timeout
         # Create a TCP/IP socket
         self._connect()
         if self._socket is None:
-            _LOGGER.error("Sokcet is None: {}".format(self._remote))
-            return bytearray(0), False
-        _LOGGER.debug("Socket {} tcp_key: {}".format(self.get_socket_info(), self._tcp_key))
+            _LOGGER.error("Sokcet is None: {}", protocol._remote)
+            return [], False
+        _LOGGER.debug("Socket {} tcp_key: {}", lazy(self.get_socket_info), protocol._tcp_key)
+        self._drain()
         # Send data
         try:
             _LOGGER.debug(
-                "Sending {} message: {}".format(self.get_socket_info(), message.hex()))
+                "Sending {} message: {}", lazy(self.get_socket_info), lazy_hex(message))
             self._socket.sendall(message)
+            send_time = time.time()
         except Exception as error:
-            _LOGGER.error("Send {} Error: {}".format(self.get_socket_info(), error))
+            _LOGGER.error("Send {} Error: {}", lazy(self.get_socket_info), error)
             self._disconnect()
-            self._retries += 1
-            return bytearray(0), True
+            protocol.failed()
+            return [], True
 
-        # Received data
+        # Received data, until a complete frame per expected reply is buffered
+        frames = []
         try:
-            response = self._socket.recv(1024)
+            self._socket.settimeout(timeout)
+            while len(frames) < expected:
+                response = self._socket.recv(1024)
+                if len(response) == 0:
+                    _LOGGER.debug("Recv {} Server Closed Socket", lazy(self.get_socket_info))
+                    self._disconnect()
+                    protocol.failed()
+                    return [], True
+                frames.extend(protocol.received(response))
         except socket.timeout as error:
-            if error.args[0] == 'timed out':
-                _LOGGER.debug("Recv {}, timed out".format(self.get_socket_info()))
-                self._retries += 1
-                return bytearray(0), True
-            else:
-                _LOGGER.debug("Recv {} TimeOut: {}".format(self.get_socket_info(), error))
+            if protocol.timed_out(frames, expected, timeout):
+                return frames, True
+            if error.args[0] != 'timed out':
+                _LOGGER.debug("Recv {} TimeOut: {}", lazy(self.get_socket_info), error)
                 self._disconnect()
-                self._retries += 1
-                return bytearray(0), True
+            return [], True
         except socket.error as error:
-            _LOGGER.debug("Recv {} Error: {}".format(self.get_socket_info(), error))
+            _LOGGER.debug("Recv {} Error: {}", lazy(self.get_socket_info), error)
             self._disconnect()
-            self._retries += 1
-            return bytearray(0), True
+            protocol.failed()
+            return [], True
         else:
-            _LOGGER.debug("Recv {} Response: {}".format(self.get_socket_info(), response.hex()))
-            if len(response) == 0:
-                _LOGGER.debug("Recv {} Server Closed Socket".format(self.get_socket_info()))
-                self._disconnect()
-                self._retries += 1
-                return bytearray(0), True
-            else:
-                self._retries = 0
-                return response, True
+            protocol.replied(send_time, sample)
+            return frames, True
+
+    def _drain(self):
+        # Nothing readable before the request is sent can be its reply
+        data = b''
+        try:
+            while select.select([self._socket], [], [], 0)[0]:
+                response = self._socket.recv(1024)
+                if len(response) == 0:
+                    # Closed, the exchange will notice
+                    break
+                data += response
+        except (OSError, ValueError):
+            pass
+        self.protocol.discard(data)
 
     def authenticate(self, token: bytearray, key: bytearray):
-        self._token, self._key = token, key
-        if not self._token or not self._key:
-            raise Exception('missing token key pair')
-        request = self.security.encode_8370(
-            self._token, MSGTYPE_HANDSHAKE_REQUEST)
-        response, _ = self.request(request)
-        response = response[8:72]
-
-        tcp_key, success = self.security.tcp_key(response, self._key)
-        if success:
-            self._tcp_key = tcp_key.hex()
-            _LOGGER.info('Got TCP key for {} tcp_key: {}'.format(self.get_socket_info(), tcp_key.hex()))
-            # After authentication, don’t send data immediately, so sleep 1s.
-            time.sleep(1)
-        else:
-            _LOGGER.error('Authentication failed for {} {}'.format(self.get_socket_info(), tcp_key.hex()))
-        return success
+        with self._lock:
+            request = self.protocol.handshake_request(token, key)
+            response, _ = self.request(request)
+            return self.protocol.handshake(response)
 
     def _authenticate(self):
-        if not self._token or not self._key:
-            raise Exception('missing token key pair')
-        return self.authenticate(self._token, self._key)
+        self.protocol.check_token_key()
+        self._connect()
+        if self.connected and self.protocol.resume_session():
+            return True
+        return self.authenticate(self.protocol._token, self.protocol._key)
 
-    def appliance_transparent_send_8370(self, data, msgtype=MSGTYPE_ENCRYPTED_REQUEST):
-        # socket_time = time.time() - self._timestamp
-        # _LOGGER.debug("Data: {} msgtype: {} len: {} socket time: {}".format(data.hex(), msgtype, len(data), socket_time))
-        if self._socket is None or self._tcp_key is None:
-            _LOGGER.debug(
-                "Socket {} invalid, Create New Socket and Get New tcp_key {}".format(self.get_socket_info(), self._tcp_key))
-            self._disconnect()
-            if self._authenticate() == False:
-                return []
-        # copy from data in order to resend data
-        original_data = bytearray.copy(data)
-        data = self.security.encode_8370(data, msgtype)
-        # time sleep retries second befor send data, default is 0
-        time.sleep(self._retries)
-        responses, b = self.request(data)
-        _LOGGER.debug("Got responses len: {}".format(len(responses)))
-        if responses[8:13] == b'ERROR':
-            self._disconnect()
-            return [b'ERROR']
-        if responses == bytearray(0) and self._retries < 2 and b:
-            packets = self.appliance_transparent_send_8370(
-                original_data, msgtype)
-            self._retries = 0
-            return packets
-        responses, self._buffer = self.security.decode_8370(
-            self._buffer + responses)
+    def _run(self, request):
+        # Perform the I/O a lan_protocol request generator asks for
+        result = None
+        while True:
+            try:
+                step = request.send(result)
+            except StopIteration as stop:
+                return stop.value
+            if step[0] == OPEN:
+                result = self._open_session()
+            elif step[0] == CLOSE:
+                result = self._disconnect()
+            elif step[0] == SLEEP:
+                result = time.sleep(step[1])
+            else:
+                result = self.request_frames(*step[1:])
+
+    def _guarded(self, request):
+        # Run request behind the circuit breaker, an exception counts as a
+        # failure so a HALF_OPEN probe never leaves the breaker stuck
+        if not self.protocol.allow():
+            return []
+        try:
+            packets = self._run(request)
+        except BaseException:
+            self.breaker.record_failure()
+            raise
+        return self.protocol.record(packets)
+
+    def submit(self, packets, matchers, encrypted):
+        '''
+        Send packets, each with the matcher of its reply, and return the
+        replies to each. Packets other callers queue while an exchange runs
+        go out together in the next write, replies are routed by matcher.
+        '''
+        requests = [pending_request(bytes(packet), matches, encrypted) for packet, matches in zip(packets, matchers)]
+        with self._inflight_lock:
+            self._inflight.extend(requests)
+        with self._lock:
+            # The holder of the lock before us may have sent ours already
+            while not requests[0].done:
+                self._send_inflight()
+        return [request.replies for request in requests]
+
+    def _send_inflight(self):
+        with self._inflight_lock:
+            batch = self.protocol.take_batch(self._inflight)
         packets = []
-        for response in responses:
-            if len(response) > 40 + 16:
-                response = self.security.aes_decrypt(response[40:-16])
-            # header lenght is 10
-            if len(response) > 10:
-                packets.append(response)
-        return packets
+        try:
+            packets = self._guarded(self.protocol.batch_request(batch))
+        finally:
+            self.protocol.correlate(batch, packets)
+
+    def appliance_transparent_send_8370(self, data, msgtype=MSGTYPE_ENCRYPTED_REQUEST):
+        with self._lock:
+            return self._guarded(self.protocol.transparent_send_8370(data, msgtype))
+
+    def appliance_transparent_send_8370_batch(self, packets, msgtype=MSGTYPE_ENCRYPTED_REQUEST):
+        # Every packet in one write, waiting for a reply to each
+        with self._lock:
+            return self._guarded(self.protocol.transparent_send_8370(
+                list(packets), msgtype, expected=len(packets)))
 
     def appliance_transparent_send(self, data):
-        # time sleep retries second befor send data, default is 0
-        time.sleep(self._retries)
-        responses, b = self.request(data)
-        _LOGGER.debug("Get responses len: {}".format(len(responses)))
-        if responses == bytearray(0) and self._retries < 2 and b:
-            packets = self.appliance_transparent_send(data)
-            self._retries = 0
-            return packets
-        packets = []
-        if responses == bytearray(0):
-            return packets
-        dlen = len(responses)
-        if responses[:2].hex() == "5a5a" and dlen > 5:
-            i = 0
-            # maybe multiple response
-            while i < dlen:
-                size = responses[i+4]
-                data = self.security.aes_decrypt(responses[i:i+size][40:-16])
-                # header lenght is 10
-                if len(data) > 10:
-                    packets.append(data)
-                i += size
-        elif responses[0] == 0xaa and dlen > 2:
-            i = 0
-            while i < dlen:
-                size = responses[i+1]
-                data = responses[i:i+size+1]
-                # header lenght is 10
-                if len(data) > 10:
-                    packets.append(data)
-                i += size + 1
-        else:
-            _LOGGER.error("Unknown responses {}".format(responses.hex()))
-        return packets
+        with self._lock:
+            return self._guarded(self.protocol.transparent_send(data))
+
+    def appliance_transparent_send_batch(self, packets):
+        # Every packet in one write, waiting for a reply to each
+        with self._lock:
+            return self._guarded(self.protocol.transparent_send(b''.join(packets), len(packets)))
@@ -0,0 +1,457 @@
+# -*- coding: UTF-8 -*-
+import time
+from msmart.circuit_breaker import circuit_breaker
+from msmart.const import FRAME_TYPE, MSGTYPE_ENCRYPTED_REQUEST, MSGTYPE_HANDSHAKE_REQUEST
+from msmart.log import get_logger, lazy, lazy_hex
+from msmart.reassembler import reassembler
+from msmart.rtt import backoff_delay, rtt_estimator
+from msmart.security import security
+from msmart.store import default_session_store
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+# Socket timeout until the device's round trip time is known
+TIMEOUT = 2
+# Resends after a timeout, all within REQUEST_DEADLINE seconds per call
+MAX_RETRIES = 2
+REQUEST_DEADLINE = 6
+# Settle delay after an 8370 handshake is learned per model, starting at 0
+SETTLE_STEP = 0.1
+MAX_SETTLE_DELAY = 1.0
+# Receive timeout for the first request after a handshake
+PROBE_TIMEOUT = 0.5
+
+# Steps a request generator asks its transport to perform
+# (OPEN,): make sure an 8370 session is up, send back True or False
+OPEN = 0
+# (CLOSE,): drop the connection
+CLOSE = 1
+# (SLEEP, seconds)
+SLEEP = 2
+# (SEND, data, timeout, sample, expected): send back request_frames()
+SEND = 3
+
+
+class pending_request:
+    '''A packet in a connection's in-flight table, waiting for its reply.'''
+    __slots__ = ('packet', 'matches', 'encrypted', 'replies', 'done')
+
+    def __init__(self, packet, matches, encrypted):
+        self.packet = packet
+        # matches(frame) tells whether frame is the reply to packet
+        self.matches = matches
+        self.encrypted = encrypted
+        self.replies = []
+        self.done = False
+
+
+class lan_protocol:
+    '''
+    The transport independent part of a LAN session: framing, 8370 keys,
+    settle probing, session resume, resends and round trip times.
+    transparent_send and transparent_send_8370 are generators yielding the
+    I/O they need, lan runs them on a socket and async_lan on asyncio streams.
+    '''
+    # Learned post handshake settle delay per model
+    _settle_delays = {}
+
+    def __init__(self, device_ip, device_id, device_port=6444):
+        self.device_ip = device_ip
+        self.device_id = device_id
+        self.device_port = device_port
+        self.security = security()
+        self._retries = 0
+        self._token = None
+        self._key = None
+        self._timestamp = time.time()
+        self._tcp_key = None
+        self._local = None
+        self._remote = device_ip + ":" + str(device_port)
+        self._reassembler = reassembler()
+        self._rtt = rtt_estimator(TIMEOUT)
+        self.breaker = circuit_breaker()
+        self._last_request = time.time()
+        self._last_activity = time.time()
+        self.model = None
+        self._settle_delay = None
+        self._ready_at = 0
+        self._probing = False
+        self._resumed = False
+        # Set when the device never answered a resumed session
+        self._skip_resume = False
+        # Reports found among stale data, handed out by correlate()
+        self._reports = []
+        # The buffered partial frame began before the request was sent
+        self._stale_partial = False
+
+    @property
+    def timeout(self):
+        return self._rtt.timeout
+
+    @property
+    def last_request(self):
+        return self._last_request
+
+    @property
+    def last_activity(self):
+        return self._last_activity
+
+    def get_socket_info(self):
+        socket_time = round(time.time() - self._timestamp, 2)
+        return "{} -> {} retries: {} time: {}".format(self._local, self._remote, self._retries, socket_time)
+
+    def connection_made(self, local):
+        self._reassembler.clear()
+        self._stale_partial = False
+        self._timestamp = time.time()
+        self._local = local
+
+    def connection_lost(self):
+        self._tcp_key = None
+
+    def set_token_key(self, token, key):
+        # True if the key pair changed, which invalidates the negotiated tcp_key
+        changed = (token, key) != (self._token, self._key)
+        self._token, self._key = token, key
+        return changed
+
+    def check_token_key(self):
+        if not self._token or not self._key:
+            raise Exception('missing token key pair')
+
+    def handshake_request(self, token, key):
+        self._token, self._key = token, key
+        self.check_token_key()
+        return self.security.encode_8370(self._token, MSGTYPE_HANDSHAKE_REQUEST)
+
+    def handshake(self, response):
+        response = response[8:72]
+
+        tcp_key, success = self.security.tcp_key(response, self._key)
+        if success:
+            self._tcp_key = tcp_key.hex()
+            _LOGGER.info('Got TCP key for {} tcp_key: {}', lazy(self.get_socket_info), lazy_hex(tcp_key))
+            # Some modules reject data sent right after the handshake, probe
+            # the first request and wait only as long as this model needs
+            self._ready_at = time.time() + self.settle_delay
+            self._probing = True
+            store = default_session_store()
+            if store:
+                store.set_session(self.device_id, self._tcp_key)
+        else:
+            _LOGGER.error('Authentication failed for {} {}', lazy(self.get_socket_info), lazy_hex(tcp_key))
+        return success
+
+    def resume_session(self):
+        # Reuse a stored tcp_key on the new connection instead of a handshake
+        if self._skip_resume:
+            self._skip_resume = False
+            return False
+        store = default_session_store()
+        tcp_key = store.get_session(self.device_id) if store else None
+        if tcp_key is None:
+            return False
+        self.security.set_tcp_key(bytes.fromhex(tcp_key))
+        self._tcp_key = tcp_key
+        self._resumed = True
+        _LOGGER.debug("Resumed stored session for {}", lazy(self.get_socket_info))
+        return True
+
+    @property
+    def settle_delay(self):
+        if self._settle_delay is None:
+            self._settle_delay = lan_protocol._settle_delays.get(self.model, 0)
+        return self._settle_delay
+
+    def _settle_remaining(self):
+        return max(0, self._ready_at - time.time())
+
+    def _probe_result(self, responses):
+        # Learn from the first request after a handshake, True if rejected
+        self._probing = False
+        self._resumed = False
+        rejected = not responses or responses[0][8:13] == b'ERROR'
+        if rejected:
+            delay = min(max(self.settle_delay * 2, SETTLE_STEP), MAX_SETTLE_DELAY)
+            _LOGGER.debug("Device {} not ready after handshake, settle delay {}s", lazy(self.get_socket_info), delay)
+        else:
+            # Decay slowly so the delay tracks the minimum that works
+            delay = round(self.settle_delay * 0.9, 3)
+        self._settle_delay = delay
+        if self.model is not None:
+            lan_protocol._settle_delays[self.model] = delay
+        return rejected
+
+    def _signed(self, frame):
+        # Whether frame is signed with the current tcp_key
+        try:
+            self.security.decode_8370_views(frame)
+        except Exception:
+            return False
+        return True
+
+    def _resume_rejected(self):
+        _LOGGER.debug("Stored session rejected by {}, doing a full handshake", lazy(self.get_socket_info))
+        self._resumed = False
+        default_session_store().disable_resume(self.device_id)
+        self._retries = 0
+
+    def _resume_unanswered(self):
+        # Resume stays enabled, only this connection does a full handshake
+        _LOGGER.debug("Stored session unanswered by {}, doing a full handshake", lazy(self.get_socket_info))
+        self._resumed = False
+        self._skip_resume = True
+        self._retries = 0
+
+    def allow(self):
+        if self.breaker.allow():
+            self._last_request = time.time()
+            return True
+        _LOGGER.debug("Circuit open for {}, failing fast", self._remote)
+        return False
+
+    def record(self, packets):
+        # A device rejecting the session with ERROR failed the exchange too
+        if packets and b'ERROR' not in packets:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        return packets
+
+    def _retry_delay(self, attempt, deadline):
+        # Jittered exponential backoff, None once retries or time run out
+        if attempt >= MAX_RETRIES:
+            return None
+        delay = backoff_delay(attempt)
+        if time.time() + delay + self._rtt.timeout > deadline:
+            return None
+        return delay
+
+    def received(self, data):
+        # Complete frames buffered after data arrived
+        _LOGGER.debug("Recv {} Response: {}", lazy(self.get_socket_info), lazy_hex(data))
+        self._reassembler.feed(data)
+        frames = list(self._reassembler.frames())
+        if self._stale_partial and frames:
+            self._stale_partial = False
+            self._set_aside(frames[:1])
+            del frames[0]
+        return frames
+
+    def replied(self, send_time, sample):
+        # Only first transmissions are timed, a late reply to a resend
+        # would look like a short round trip
+        self._retries = 0
+        self._last_activity = time.time()
+        if sample:
+            self._rtt.sample(self._last_activity - send_time)
+
+    def timed_out(self, frames, expected, timeout):
+        # Drop any partial frame, the request will be sent again.
+        # True if part of a batch was answered and the replies should be kept
+        self._reassembler.clear()
+        self._stale_partial = False
+        if frames:
+            _LOGGER.debug("Recv {}, {} of {} replies", lazy(self.get_socket_info), len(frames), expected)
+            self._retries = 0
+            self._last_activity = time.time()
+            return True
+        self._rtt.timed_out()
+        _LOGGER.debug("Recv {}, timed out after {:.2f}s", lazy(self.get_socket_info), timeout)
+        self._retries += 1
+        return False
+
+    def failed(self):
+        self._retries += 1
+
+    @staticmethod
+    def take_batch(inflight):
+        # The queued requests that go out in the next write, all sent the
+        # same way as the oldest one
+        encrypted = inflight[0].encrypted
+        batch = [request for request in inflight if request.encrypted == encrypted]
+        inflight[:] = [request for request in inflight if request.encrypted != encrypted]
+        return batch
+
+    def batch_request(self, batch):
+        # Request generator sending every packet of batch in one write
+        packets = [request.packet for request in batch]
+        if batch[0].encrypted:
+            return self.transparent_send_8370(packets, expected=len(packets))
+        return self.transparent_send(b''.join(packets), len(packets))
+
+    def correlate(self, batch, packets):
+        '''
+        Hand each reply to a request waiting for one it matches. Replies come
+        in send order, so matching runs from the newest and extra replies in
+        front, late answers to a timed out request, are dropped. ERROR answers
+        every request, reports the device pushed go to the first request.
+        '''
+        waiting = list(batch)
+        owners = [None] * len(packets)
+        for index in reversed(range(len(packets))):
+            packet = packets[index]
+            if packet == b'ERROR' or self._is_report(packet):
+                continue
+            for request in reversed(waiting):
+                if request.matches(packet):
+                    owners[index] = request
+                    waiting.remove(request)
+                    break
+        for packet, owner in zip(packets, owners):
+            if owner is not None:
+                owner.replies.append(packet)
+            elif packet == b'ERROR':
+                for request in waiting:
+                    if not request.replies:
+                        request.replies.append(packet)
+            elif self._is_report(packet):
+                batch[0].replies.append(packet)
+            else:
+                _LOGGER.debug("Dropped unmatched reply from {} {}", lazy(self.get_socket_info), lazy_hex(packet))
+        # Reports found among stale data predate every reply
+        batch[0].replies[:0] = self._reports
+        self._reports = []
+        for request in batch:
+            request.done = True
+
+    @staticmethod
+    def _is_report(packet):
+        return len(packet) > 10 and packet[9] in (FRAME_TYPE.Report, FRAME_TYPE.ABNL_REPORT)
+
+    def discard(self, data):
+        '''
+        Drop data that arrived before a request was sent, a late reply to a
+        request that timed out would be taken for the answer to this one.
+        Reports the device pushed are kept for correlate().
+        '''
+        frames = self.received(data) if data else []
+        # A partial frame is finished by data read for the request, received()
+        # sets it aside then
+        self._stale_partial = len(self._reassembler) > 0
+        self._set_aside(frames)
+
+    def _set_aside(self, frames):
+        if not frames:
+            return
+        try:
+            packets = self.decode(frames)
+        except Exception as error:
+            _LOGGER.debug("Dropped {} undecodable stale frames from {}: {}", len(frames), lazy(self.get_socket_info), error)
+            return
+        reports = [packet for packet in packets if self._is_report(packet)]
+        self._reports.extend(reports)
+        _LOGGER.debug("Dropped {} stale replies from {}", len(packets) - len(reports), lazy(self.get_socket_info))
+
+    def decode(self, frames):
+        # Frames the device sent on its own
+        self._last_activity = time.time()
+        if self._tcp_key is not None:
+            return self._decode_8370_responses(frames)
+        return self._decode_responses(frames)
+
+    def transparent_send_8370(self, data, msgtype=MSGTYPE_ENCRYPTED_REQUEST, expected=1):
+        '''
+        Request generator sending data, or a list of packets in one write,
+        over an 8370 session. Returns the decoded packets.
+        '''
+        deadline = time.time() + REQUEST_DEADLINE
+        # copy from data in order to resend data, a list is sent as a batch
+        packets = [bytes(packet) for packet in data] if isinstance(data, list) else [bytes(data)]
+        settle_retry = True
+        attempt = 0
+        while True:
+            # Settle and resume retries start over, but within the deadline
+            if time.time() >= deadline:
+                _LOGGER.debug("Request to {} out of time", lazy(self.get_socket_info))
+                return []
+            if not (yield (OPEN,)):
+                return []
+            data = b''.join(self.security.encode_8370(bytearray(packet), msgtype) for packet in packets)
+            settle = min(self._settle_remaining(), max(0, deadline - time.time()))
+            if settle:
+                yield (SLEEP, settle)
+            probing, resumed = self._probing, self._resumed
+            timeout = self._rtt.timeout
+            if probing or resumed:
+                timeout = min(timeout, PROBE_TIMEOUT)
+            timeout = max(min(timeout, deadline - time.time()), 0.01)
+            responses, b = yield (SEND, data, timeout, attempt == 0, expected)
+            _LOGGER.debug("Got responses count: {}", len(responses))
+            # A timeout is retried as usual. ERROR, a reply signed with
+            # another key or a dropped connection reject the stored key
+            if resumed and (responses or self._tcp_key is None):
+                if not responses or responses[0][8:13] == b'ERROR' or not self._signed(responses[0]):
+                    self._resume_rejected()
+                    yield (CLOSE,)
+                    attempt = 0
+                    continue
+                self._resumed = False
+            if probing and self._probe_result(responses) and settle_retry:
+                if responses:
+                    # Rejected with ERROR, the module wants a new handshake
+                    yield (CLOSE,)
+                else:
+                    self._ready_at = time.time() + self.settle_delay
+                self._retries = 0
+                settle_retry = self.settle_delay < MAX_SETTLE_DELAY
+                attempt = 0
+                continue
+            if responses and responses[0][8:13] == b'ERROR':
+                yield (CLOSE,)
+                return [b'ERROR']
+            delay = None if responses or not b else self._retry_delay(attempt, deadline)
+            if delay is None and resumed and b and not responses:
+                self._resume_unanswered()
+                yield (CLOSE,)
+                attempt = 0
+                continue
+            if delay is None:
+                return self._decode_8370_responses(responses)
+            yield (SLEEP, delay)
+            attempt += 1
+
+    def _decode_8370_responses(self, responses):
+        packets = []
+        for frame in responses:
+            if frame[:2] != b'\x83\x70':
+                _LOGGER.error("Unknown responses {}", lazy_hex(frame))
+                continue
+            decoded, _ = self.security.decode_8370_views(frame)
+            for response in decoded:
+                if len(response) > 40 + 16:
+                    response = self.security.aes_decrypt(response[40:-16])
+                # header lenght is 10
+                if len(response) > 10:
+                    packets.append(bytes(response))
+        return packets
+
+    def transparent_send(self, data, expected=1):
+        '''Request generator sending data over a plain v2 connection, returns the decoded packets.'''
+        deadline = time.time() + REQUEST_DEADLINE
+        attempt = 0
+        while True:
+            responses, b = yield (SEND, data, self._rtt.timeout, attempt == 0, expected)
+            _LOGGER.debug("Get responses count: {}", len(responses))
+            delay = None if responses or not b else self._retry_delay(attempt, deadline)
+            if delay is None:
+                return self._decode_responses(responses)
+            yield (SLEEP, delay)
+            attempt += 1
+
+    def _decode_responses(self, responses):
+        packets = []
+        for frame in responses:
+            if frame[:2] == b'\x5a\x5a':
+                data = self.security.aes_decrypt(frame[40:-16])
+            elif frame[0] == 0xaa:
+                data = frame
+            else:
+                _LOGGER.error("Unknown responses {}", lazy_hex(frame))
+                continue
+            # header lenght is 10
+            if len(data) > 10:
+                packets.append(data)
+        return packets
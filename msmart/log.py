@@ -0,0 +1,121 @@
+# -*- coding: UTF-8 -*-
+import logging
+import threading
+import time
+
+VERSION = '0.2.5'
+
+# Seconds between two emitted copies of the same throttled warning
+THROTTLE_INTERVAL = 60
+
+
+class lazy:
+    '''function(*args), only called when a record is emitted.'''
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+class lazy_hex:
+    '''Hex of a buffer, only encoded when a record is emitted.'''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex()
+
+
+class _message(str):
+    '''
+    str.format template, formatted with args when the record is emitted.
+    It is the template str itself, so filters can treat record.msg as usual.
+    '''
+
+    def __new__(cls, format, args):
+        message = super().__new__(cls, format)
+        message.args = args
+        return message
+
+    def __str__(self):
+        if not self.args:
+            return str.__str__(self)
+        return self.format(*self.args)
+
+
+class lazy_logger(logging.LoggerAdapter):
+    '''
+    Logger taking str.format style arguments, _LOGGER.debug("Recv {}", lazy_hex(data)).
+    Nothing is formatted or hex encoded unless the level is enabled.
+    '''
+
+    def __init__(self, logger, extra=None):
+        super().__init__(logger, extra)
+        self._throttled = {}
+        self._throttle_lock = threading.Lock()
+
+    def _emit(self, level, message, kwargs):
+        # Through process() and the public Logger.log, stacklevel skips
+        # this method and the level method to report the caller's line
+        message, kwargs = self.process(message, kwargs)
+        kwargs['stacklevel'] = kwargs.get('stacklevel', 1) + 2
+        self.logger.log(level, message, **kwargs)
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            self._emit(level, _message(msg, args), kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        if self.isEnabledFor(logging.DEBUG):
+            self._emit(logging.DEBUG, _message(msg, args), kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        if self.isEnabledFor(logging.INFO):
+            self._emit(logging.INFO, _message(msg, args), kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        if self.isEnabledFor(logging.WARNING):
+            self._emit(logging.WARNING, _message(msg, args), kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        if self.isEnabledFor(logging.ERROR):
+            self._emit(logging.ERROR, _message(msg, args), kwargs)
+
+    def exception(self, msg, *args, exc_info=True, **kwargs):
+        if self.isEnabledFor(logging.ERROR):
+            self._emit(logging.ERROR, _message(msg, args), dict(kwargs, exc_info=exc_info))
+
+    def critical(self, msg, *args, **kwargs):
+        if self.isEnabledFor(logging.CRITICAL):
+            self._emit(logging.CRITICAL, _message(msg, args), kwargs)
+
+    def throttled_warning(self, msg, *args, interval=THROTTLE_INTERVAL, key=None):
+        '''
+        Warn at most once per interval for each message, counting the copies
+        dropped. Messages are told apart by their formatted arguments, or by key.
+        '''
+        if not self.isEnabledFor(logging.WARNING):
+            return
+        if key is None:
+            key = (msg, tuple(str(arg) for arg in args))
+        now = time.monotonic()
+        with self._throttle_lock:
+            last, suppressed = self._throttled.get(key, (None, 0))
+            if last is not None and now - last < interval:
+                self._throttled[key] = (last, suppressed + 1)
+                return
+            self._throttled[key] = (now, 0)
+        message = _message(msg, args)
+        if suppressed:
+            message = _message("{} ({} similar messages suppressed)", (message, suppressed))
+        self._emit(logging.WARNING, message, {})
+
+
+def get_logger(name):
+    return lazy_logger(logging.getLogger(name))
@@ -1,21 +1,23 @@
-import datetime
-import logging
+from collections import OrderedDict
+import threading
+import time
 from msmart.base_command import command as base_command
+from msmart.log import get_logger
 from msmart.security import security
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 
+# Only the stateless v2 helpers are used, one instance serves every packet
+_security = security()
 
-class packet_builder:
+# Encrypted frames of constant queries, a few kinds times 256 message ids
+FRAME_CACHE_SIZE = 1024
 
-    def __init__(self, device_id: int):
-        self.command = None
-        self.security = security()
-        # aa20ac00000000000003418100ff03ff000200000000000000000000000006f274
-        # Init the packet with the header data.
-        self.packet = bytearray([
+# aa20ac00000000000003418100ff03ff000200000000000000000000000006f274
+# The header data, only the length and date&time vary per packet.
+HEADER = bytes([
             # 2 bytes - StaicHeader
             0x5a, 0x5a,
             # 2 bytes - mMessageType
@@ -33,21 +35,98 @@ class packet_builder:
             # 12 bytes
             0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00
         ])
-        self.packet[12:20] = self.packet_time()
-        self.packet[20:28] = device_id.to_bytes(8, 'little')
+
+
+class frame_cache:
+    '''Thread safe LRU of encrypted inner frames, keyed by command.frame_key().'''
+
+    def __init__(self, max_size=FRAME_CACHE_SIZE):
+        self.max_size = max_size
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        with self._lock:
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            if len(self._frames) > self.max_size:
+                self._frames.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+
+_frame_cache = frame_cache()
+
+
+class packet_builder:
+
+    def __init__(self, device_id: int):
+        self.command = None
+        self.security = _security
+        # Header template with the device id, compiled once per builder
+        template = bytearray(HEADER)
+        template[20:28] = device_id.to_bytes(8, 'little')
+        self._template = bytes(template)
+        # Packets are written into per thread buffers, one per packet size
+        self._local = threading.local()
+        self.packet = None
 
     def set_command(self, command: base_command, add_crc8: bool = True):
         self.command = command.pack()
 
     def finalize(self):
-        # Append the command data(48 bytes) to the packet
-        self.packet.extend(self.security.aes_encrypt(self.command)[:48])
-        # PacketLenght
-        self.packet[4:6] = (len(self.packet) + 16).to_bytes(2, 'little')
-        # Append a basic checksum data(16 bytes) to the packet
-        self.packet.extend(self.encode32(self.packet))
+        # A copy the caller owns, the buffer is reused by the next packet
+        self.packet = bytes(self._finalize(self.command))
         return self.packet
 
+    def build(self, command: base_command):
+        '''
+        Pack and encrypt command into this thread's buffer and return it.
+        The buffer is reused by the next build() of the same size, copy it to keep it.
+        '''
+        key = command.frame_key()
+        if key is None:
+            return self._finalize(command.pack())
+        body = _frame_cache.get(key)
+        if body is None:
+            body = self._encrypt(command.pack())
+            _frame_cache.put(key, body)
+        return self._assemble(body)
+
+    def _encrypt(self, data):
+        # The command data(48 bytes)
+        return self.security.aes_encrypt(data)[:48]
+
+    def _finalize(self, data):
+        return self._assemble(self._encrypt(data))
+
+    def _assemble(self, body):
+        size = 40 + len(body) + 16
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        packet = buffers.get(size)
+        if packet is None:
+            packet = buffers[size] = bytearray(size)
+            packet[:40] = self._template
+            # PacketLenght
+            packet[4:6] = size.to_bytes(2, 'little')
+        packet[12:20] = self.packet_time()
+        packet[40:-16] = body
+        # A basic checksum data(16 bytes)
+        with memoryview(packet) as view:
+            packet[-16:] = self.encode32(view[:-16])
+        return packet
+
     def encode32(self, data: bytearray):
         # 16 bytes encode32
         return self.security.encode32_data(data)
@@ -56,10 +135,8 @@ class packet_builder:
         return (~ sum(data) + 1) & 0xff
 
     def packet_time(self):
-        t = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')[
-            :16]
-        b = bytearray()
-        for i in range(0, len(t), 2):
-            d = int(t[i:i+2])
-            b.insert(0, d)
-        return b
+        # Centiseconds, seconds, minutes, hours, day, month, year % 100, century
+        now = time.time()
+        t = time.localtime(now)
+        return bytes((int(now % 1 * 100), t.tm_sec, t.tm_min, t.tm_hour,
+                      t.tm_mday, t.tm_mon, t.tm_year % 100, t.tm_year // 100))
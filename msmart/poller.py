@@ -0,0 +1,371 @@
+# -*- coding: UTF-8 -*-
+import errno
+import selectors
+import socket
+import time
+from msmart.lan_protocol import CLOSE, OPEN, SLEEP, TIMEOUT, pending_request
+from msmart.log import get_logger
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+# Session states, the I/O the session's request generator waits for
+IDLE = 0
+CONNECTING = 1
+HANDSHAKE = 2
+WAITING = 3
+SLEEPING = 4
+
+
+class _poll_session:
+    '''
+    Non-blocking I/O state of one device. The socket, framing and 8370 state
+    are the device's pooled lan, held by the poller while a command is out.
+    '''
+
+    def __init__(self, device):
+        self.device = device
+        self.lan = device._lan_service
+        self.socket = None
+        self.events = 0
+        self.state = IDLE
+        self.outbox = b''
+        self.cmd = None
+        self.batch = None
+        self.request = None
+        # Step the current connect is for, OPEN or a SEND
+        self.connect_for = None
+        self.send = None
+        self.frames = []
+        self.send_time = 0
+        self.io_time = 0
+        self.wake_at = 0
+
+    @property
+    def protocol(self):
+        return self.lan.protocol
+
+    @property
+    def version(self):
+        return self.device._protocol_version
+
+
+class poller:
+    '''
+    Single threaded poller for many devices.
+    Each device's command runs through the same lan_protocol request
+    generator as lan and async_lan, so settle delays, probing, session
+    resume, resends and ERROR handling are shared. Here one selector drives
+    the devices' pooled sockets, made non-blocking for the poll, and the
+    sleeps and receive timeouts are timers of the select loop. Decoded
+    frames are fed to each device's _process_response, so devices stay
+    usable as before. A device busy with a blocking request is skipped.
+    '''
+
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self._selector = selectors.DefaultSelector()
+        self._sessions = {}
+
+    def add(self, device):
+        if device not in self._sessions:
+            self._sessions[device] = _poll_session(device)
+
+    def remove(self, device):
+        # Sessions are only active inside poll(), the pool owns the sockets
+        self._sessions.pop(device, None)
+
+    def close(self):
+        self._sessions.clear()
+        self._selector.close()
+
+    def poll(self, timeout=None):
+        '''
+        Query every device that is due by its poll_interval(), returns the
+        number of devices that replied.
+        '''
+        now = time.time()
+        deadline = now + (timeout or self.timeout)
+        active = set()
+        replied = 0
+        for session in self._sessions.values():
+            cmd = session.device._state_command()
+            if cmd is None or not session.device.poll_due(now):
+                continue
+            # One bad device must not abort the poll for the others
+            try:
+                if self._start(session, cmd):
+                    active.add(session)
+            except Exception as error:
+                _LOGGER.error("Poll {} Error: {}", session.protocol._remote, error)
+                self._fail(session)
+        replied += self._collect(active)
+        while active:
+            now = time.time()
+            if now >= deadline:
+                break
+            wake_at = min([deadline] + [session.wake_at for session in active if session.wake_at])
+            if self._selector.get_map():
+                ready = self._selector.select(max(wake_at - now, 0))
+            else:
+                # Every active session is sleeping
+                time.sleep(max(wake_at - now, 0))
+                ready = []
+            for key, mask in ready:
+                # Skip events of a socket an earlier handler replaced
+                if key.fileobj is key.data.socket:
+                    self._guard(key.data, self._handle, key.data, mask)
+            now = time.time()
+            for session in list(active):
+                if session.wake_at and now >= session.wake_at:
+                    session.wake_at = 0
+                    self._guard(session, self._expired, session)
+            replied += self._collect(active)
+        for session in active:
+            _LOGGER.debug("Poll timed out {}", session.protocol.get_socket_info())
+            self._fail(session)
+        return replied
+
+    def _collect(self, active):
+        # Drop finished sessions from active, returns how many got a reply
+        replied = 0
+        for session in [session for session in active if session.cmd is None]:
+            active.discard(session)
+            replies = session.batch[0].replies if session.batch else []
+            replied += len(replies) > 0 and replies[0] != b'ERROR'
+        return replied
+
+    def _guard(self, session, handler, *args):
+        if session.cmd is None:
+            return
+        try:
+            handler(*args)
+        except Exception as error:
+            _LOGGER.error("Poll {} Error: {}", session.protocol.get_socket_info(), error)
+            self._fail(session)
+
+    def _start(self, session, cmd):
+        device, lan = session.device, session.device._lan_service
+        # The lan is shared with blocking callers, leave a busy one alone
+        if not lan._lock.acquire(blocking=False):
+            return False
+        if not lan.protocol.allow():
+            lan._lock.release()
+            return False
+        session.lan = lan
+        session.cmd = cmd
+        session.batch = None
+        session.send_time = time.time()
+        device._assign_message_id(cmd)
+        encrypted = session.version == 3
+        if encrypted:
+            lan.set_token_key(device._token, device._key)
+        # Kept until the reply, copied out of the builder's reused buffer
+        session.batch = [pending_request(bytes(device._build_packet(cmd)), cmd.matches, encrypted)]
+        session.request = session.protocol.batch_request(session.batch)
+        if lan._socket is not None:
+            session.socket = lan._socket
+            session.socket.setblocking(False)
+        self._step(session, None)
+        return True
+
+    def _step(self, session, result):
+        # Run the request generator up to the next step that needs waiting
+        protocol, lan = session.protocol, session.lan
+        while True:
+            try:
+                step = session.request.send(result)
+            except StopIteration as stop:
+                return self._done(session, stop.value)
+            if step[0] == OPEN:
+                if lan._socket is not None and protocol._tcp_key is not None:
+                    result = True
+                    continue
+                self._disconnect(session)
+                protocol.check_token_key()
+                return self._connect(session, OPEN)
+            elif step[0] == CLOSE:
+                result = self._disconnect(session)
+            elif step[0] == SLEEP:
+                self._watch(session, 0)
+                session.state = SLEEPING
+                session.wake_at = time.time() + step[1]
+                return
+            else:
+                session.send = step[1:]
+                if lan._socket is None:
+                    return self._connect(session, step[0])
+                return self._send(session)
+
+    def _connect(self, session, connect_for):
+        protocol = session.protocol
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        result = sock.connect_ex((protocol.device_ip, protocol.device_port))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            _LOGGER.error("Connect Error: {}:{} {}", protocol.device_ip, protocol.device_port, errno.errorcode.get(result, result))
+            sock.close()
+            return self._connected(session, connect_for, False)
+        session.lan._socket = session.socket = sock
+        session.connect_for = connect_for
+        session.state = CONNECTING
+        session.wake_at = time.time() + protocol.timeout
+        self._watch(session, selectors.EVENT_WRITE)
+
+    def _connected(self, session, connect_for, success):
+        protocol = session.protocol
+        if not success:
+            self._disconnect(session)
+            # As lan: OPEN fails, a SEND reports no socket
+            return self._step(session, False if connect_for == OPEN else ([], False))
+        protocol.connection_made(":".join('%s' % i for i in session.socket.getsockname()))
+        if connect_for != OPEN:
+            return self._send(session)
+        if protocol.resume_session():
+            return self._step(session, True)
+        session.send = (protocol.handshake_request(protocol._token, protocol._key), protocol.timeout, True, 1)
+        self._send(session, HANDSHAKE)
+
+    def _send(self, session, state=WAITING):
+        data, timeout, _, _ = session.send
+        self._drain(session)
+        session.state = state
+        session.frames = []
+        session.outbox = bytes(data)
+        session.io_time = time.time()
+        session.wake_at = session.io_time + timeout
+        self._watch(session, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def _drain(self, session):
+        # Nothing readable before the request is sent can be its reply
+        data = b''
+        while True:
+            try:
+                response = session.socket.recv(1024)
+            except OSError:
+                break
+            if len(response) == 0:
+                break
+            data += response
+        session.protocol.discard(data)
+
+    def _received(self, session, result):
+        # Finish the current SEND, or the handshake of an OPEN
+        session.wake_at = 0
+        self._watch(session, 0)
+        if session.state == HANDSHAKE:
+            frames, _ = result
+            return self._step(session, session.protocol.handshake(b''.join(frames)))
+        return self._step(session, result)
+
+    def _lost(self, session):
+        self._disconnect(session)
+        session.protocol.failed()
+        self._received(session, ([], True))
+
+    def _handle(self, session, mask):
+        protocol = session.protocol
+        if session.state == CONNECTING:
+            error = session.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                _LOGGER.error("Connect Error: {} {}", protocol._remote, errno.errorcode.get(error, error))
+            session.wake_at = 0
+            self._watch(session, 0)
+            return self._connected(session, session.connect_for, not error)
+        if session.state not in (WAITING, HANDSHAKE):
+            return
+        if mask & selectors.EVENT_WRITE and session.outbox:
+            try:
+                sent = session.socket.send(session.outbox)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as error:
+                _LOGGER.error("Send {} Error: {}", protocol.get_socket_info(), error)
+                return self._lost(session)
+            session.outbox = session.outbox[sent:]
+            if not session.outbox:
+                session.io_time = time.time()
+                self._watch(session, selectors.EVENT_READ)
+        if mask & selectors.EVENT_READ:
+            try:
+                response = session.socket.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                _LOGGER.debug("Recv {} Error: {}", protocol.get_socket_info(), error)
+                return self._lost(session)
+            if len(response) == 0:
+                _LOGGER.debug("Recv {} Server Closed Socket", protocol.get_socket_info())
+                return self._lost(session)
+            session.frames.extend(protocol.received(response))
+            _, _, sample, expected = session.send
+            if len(session.frames) >= expected:
+                protocol.replied(session.io_time, sample)
+                self._received(session, (session.frames, True))
+
+    def _expired(self, session):
+        protocol = session.protocol
+        if session.state == SLEEPING:
+            session.state = IDLE
+            return self._step(session, None)
+        if session.state == CONNECTING:
+            _LOGGER.error("Connect Error: {}:{} timed out", protocol.device_ip, protocol.device_port)
+            self._watch(session, 0)
+            return self._connected(session, session.connect_for, False)
+        _, timeout, _, expected = session.send
+        if protocol.timed_out(session.frames, expected, timeout):
+            return self._received(session, (session.frames, True))
+        self._received(session, ([], True))
+
+    def _done(self, session, packets):
+        device, protocol = session.device, session.protocol
+        protocol.correlate(session.batch, protocol.record(packets))
+        responses = device._handle_responses(session.batch[0].replies, session.send_time)
+        self._finish(session)
+        for response in responses:
+            device._process_response(response)
+
+    def _watch(self, session, events):
+        # Selector interest of the session's socket, 0 for none
+        if session.socket is None or events == session.events:
+            return
+        if not events:
+            self._selector.unregister(session.socket)
+        elif not session.events:
+            self._selector.register(session.socket, events, session)
+        else:
+            self._selector.modify(session.socket, events, session)
+        session.events = events
+
+    def _disconnect(self, session):
+        self._watch(session, 0)
+        session.lan._disconnect()
+        session.socket = None
+
+    def _finish(self, session):
+        # Hand the socket back to the lan in blocking mode
+        self._watch(session, 0)
+        if session.socket is not None and session.socket is session.lan._socket:
+            session.socket.settimeout(session.protocol.timeout)
+        self._release(session)
+
+    def _fail(self, session):
+        if session.cmd is not None:
+            if session.request is not None:
+                session.request.close()
+            session.device._handle_responses([], session.send_time)
+            session.lan.breaker.record_failure()
+            self._disconnect(session)
+            self._release(session)
+        return True
+
+    def _release(self, session):
+        session.socket = None
+        session.events = 0
+        session.outbox = b''
+        session.state = IDLE
+        session.wake_at = 0
+        session.request = None
+        session.cmd = None
+        session.lan._lock.release()
@@ -0,0 +1,180 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import threading
+import time
+from msmart.async_lan import async_lan
+from msmart.lan import lan
+from msmart.log import get_logger
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+# The wifi module drops TCP connections that stay silent for about a minute,
+# so ping well before that.
+KEEPALIVE_INTERVAL = 30
+# Close sockets nobody has used for this long
+IDLE_TIMEOUT = 300
+
+
+class connection_pool:
+    '''
+    Process wide registry of lan and async_lan sessions keyed by
+    (ip, port, device_id). Devices sharing a key share one socket and one
+    8370 tcp_key, and both transports of a key share one circuit breaker.
+    Every acquire is paired with a release, the last one closes the session.
+    Keepalives and idle reaping start with the first acquire: lan sessions
+    on a background thread, async_lan sessions as a task on their event loop.
+    '''
+
+    def __init__(self, keepalive_interval=KEEPALIVE_INTERVAL, idle_timeout=IDLE_TIMEOUT):
+        self.keepalive_interval = keepalive_interval
+        self.idle_timeout = idle_timeout
+        # key -> [session, users]
+        self._sessions = {}
+        self._async_sessions = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._task = None
+
+    def acquire(self, device_ip, device_id, device_port=6444):
+        session = self._acquire(self._sessions, lan, device_ip, device_id, device_port)
+        self.start()
+        return session
+
+    def acquire_async(self, device_ip, device_id, device_port=6444):
+        # Called from the event loop the session will be used on
+        session = self._acquire(self._async_sessions, async_lan, device_ip, device_id, device_port)
+        self._start_async()
+        return session
+
+    def _acquire(self, sessions, factory, device_ip, device_id, device_port):
+        key = (device_ip, device_port, device_id)
+        with self._lock:
+            entry = sessions.get(key)
+            if entry is None:
+                _LOGGER.debug("New {} session for {}:{} id: {}", factory.__name__, device_ip, device_port, device_id)
+                session = factory(device_ip, device_id, device_port)
+                other = self._async_sessions if sessions is self._sessions else self._sessions
+                if key in other:
+                    session.protocol.breaker = other[key][0].breaker
+                entry = sessions[key] = [session, 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, session):
+        if self._release(self._sessions, session):
+            session.close()
+
+    def release_async(self, session):
+        if self._release(self._async_sessions, session):
+            session.close_soon()
+
+    def _release(self, sessions, session):
+        # True once the last user released session
+        key = (session.device_ip, session.device_port, session.device_id)
+        with self._lock:
+            entry = sessions.get(key)
+            if entry is None or entry[0] is not session:
+                return False
+            entry[1] -= 1
+            if entry[1] > 0:
+                return False
+            del sessions[key]
+        _LOGGER.debug("Released session {}", session.get_socket_info())
+        return True
+
+    def discard(self, device_ip, device_id, device_port=6444):
+        key = (device_ip, device_port, device_id)
+        with self._lock:
+            entry = self._sessions.pop(key, None)
+            async_entry = self._async_sessions.pop(key, None)
+        if entry:
+            entry[0].close()
+        if async_entry:
+            async_entry[0].close_soon()
+
+    def close_all(self):
+        with self._lock:
+            sessions = [entry[0] for entry in self._sessions.values()]
+            async_sessions = [entry[0] for entry in self._async_sessions.values()]
+        for session in sessions:
+            session.close()
+        for session in async_sessions:
+            session.close_soon()
+
+    def _due(self, sessions, now):
+        # Sessions to reap and sessions to ping
+        with self._lock:
+            sessions = [entry[0] for entry in sessions.values()]
+        idle, quiet = [], []
+        for session in sessions:
+            if not session.connected:
+                continue
+            if now - session.last_request >= self.idle_timeout:
+                idle.append(session)
+            elif now - session.last_activity >= self.keepalive_interval:
+                quiet.append(session)
+        return idle, quiet
+
+    def maintain(self):
+        idle, quiet = self._due(self._sessions, time.time())
+        for session in idle:
+            _LOGGER.debug("Reaping idle socket {}", session.get_socket_info())
+            session.close()
+        for session in quiet:
+            session.keepalive()
+
+    async def async_maintain(self):
+        idle, quiet = self._due(self._async_sessions, time.time())
+        for session in idle:
+            _LOGGER.debug("Reaping idle socket {}", session.get_socket_info())
+            await session.close()
+        for session in quiet:
+            await session.keepalive()
+
+    def start(self, interval=None):
+        if self._thread is not None:
+            return
+        interval = interval or self.keepalive_interval / 3
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name="msmart-pool", daemon=True)
+        self._thread.start()
+
+    def _start_async(self, interval=None):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        self._task = loop.create_task(self._async_run(interval or self.keepalive_interval / 3))
+
+    def stop(self):
+        if self._task is not None:
+            loop = self._task.get_loop()
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._task.cancel)
+            self._task = None
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.maintain()
+            except Exception as error:
+                _LOGGER.error("Connection pool maintenance error: {}", error)
+
+    async def _async_run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.async_maintain()
+            except Exception as error:
+                _LOGGER.error("Connection pool maintenance error: {}", error)
+
+
+default_pool = connection_pool()
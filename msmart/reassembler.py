@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+import msmart.crc8 as crc8
+from msmart.log import get_logger
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+# Upper bound for buffered, not yet complete data
+MAX_BUFFER_SIZE = 64 * 1024
+
+
+class reassembler:
+    '''
+    Incremental stream reassembler for 5a5a, 8370 and raw 0xAA frames.
+    feed() raw reads in, frames() yields every complete frame and keeps
+    any partial frame for the next read.
+    '''
+
+    def __init__(self, max_size=MAX_BUFFER_SIZE):
+        self._buffer = bytearray()
+        # Read offset into _buffer, consumed bytes are dropped lazily
+        self._start = 0
+        self._max_size = max_size
+
+    def __len__(self):
+        return len(self._buffer) - self._start
+
+    def clear(self):
+        self._buffer = bytearray()
+        self._start = 0
+
+    def feed(self, data):
+        # Compact once the consumed head dominates the buffer
+        if self._start and self._start >= len(self._buffer) // 2:
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+        overflow = len(self) - self._max_size
+        if overflow > 0:
+            _LOGGER.warning("Frame buffer overflow, dropping {} bytes", overflow)
+            self._start += overflow
+            self._resync(self._start)
+
+    def frames(self):
+        while True:
+            size = self._frame_size()
+            if size is None:
+                return
+            start = self._start
+            with memoryview(self._buffer) as mv:
+                frame = bytes(mv[start:start + size])
+            self._start = start + size
+            yield frame
+
+    def _frame_size(self):
+        # Size of the complete frame at the head of the buffer, None if incomplete
+        buffer = self._buffer
+        while True:
+            start = self._start
+            available = len(buffer) - start
+            if available < 2:
+                return None
+            first, second = buffer[start], buffer[start + 1]
+            if first == 0x5a and second == 0x5a:
+                if available < 6:
+                    return None
+                size = buffer[start + 4] | buffer[start + 5] << 8
+                valid = size >= 56
+            elif first == 0x83 and second == 0x70:
+                if available < 6:
+                    return None
+                size = (buffer[start + 2] << 8 | buffer[start + 3]) + 8
+                valid = buffer[start + 4] == 0x20
+            elif first == 0xaa:
+                if available < 4:
+                    return None
+                size = second + 1
+                valid = size > 10
+            else:
+                valid = False
+            if not valid:
+                self._resync(start + 1)
+                continue
+            if available < size:
+                return None
+            # Modules leave the sync byte at 0, a raw frame is only known to
+            # start here once its checksum matches
+            if first == 0xaa and not self._checksum_ok(start, size):
+                self._resync(start + 1)
+                continue
+            return size
+
+    def _checksum_ok(self, start, size):
+        with memoryview(self._buffer) as mv:
+            return crc8.checksum(mv[start:start + size - 1]) == mv[start + size - 1]
+
+    def _resync(self, position):
+        # Skip to the next byte that can start a frame
+        buffer = self._buffer
+        end = len(buffer)
+        skipped = self._start
+        while position < end and buffer[position] not in (0x5a, 0x83, 0xaa):
+            position += 1
+        self._start = position
+        _LOGGER.debug("Skipped {} bytes of unframed data", position - skipped)
@@ -0,0 +1,53 @@
+# -*- coding: UTF-8 -*-
+import random
+
+VERSION = '0.2.5'
+
+# Timeout used until the first sample, and the ceiling afterwards
+INITIAL_TIMEOUT = 2
+# RFC 6298's floor, devices often take hundreds of ms to answer and a reply
+# later than the timeout is taken for the answer to the next request
+MIN_TIMEOUT = 1
+MAX_TIMEOUT = 2
+# Retry delays grow as BACKOFF_BASE * 2 ** attempt, with full jitter
+BACKOFF_BASE = 0.25
+
+
+class rtt_estimator:
+    '''
+    Smoothed round trip time and variance as in TCP's RTO estimator (RFC 6298).
+    timeout is srtt + 4 * rttvar, clamped, and doubles on every timeout until
+    the next sample.
+    '''
+
+    def __init__(self, initial_timeout=INITIAL_TIMEOUT, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT):
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = None
+        self._backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self._backoff = 1
+
+    def timed_out(self):
+        self._backoff = min(self._backoff * 2, 64)
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            timeout = self.initial_timeout
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+        return min(max(timeout * self._backoff, self.min_timeout), self.max_timeout)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE):
+    return random.uniform(0, base * 2 ** attempt)
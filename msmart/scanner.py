@@ -2,14 +2,15 @@
 import asyncio
 from ipaddress import IPv4Network
 import ifaddr
-import logging
 import socket
 from threading import Lock
 
 from msmart.cloud import cloud
 from msmart.const import BROADCAST_MSG, DEVICE_INFO_MSG, OPEN_MIDEA_APP_ACCOUNT, OPEN_MIDEA_APP_PASSWORD
 from msmart.device import air_conditioning as ac
+from msmart.log import get_logger, lazy_hex
 from msmart.security import get_udpid, security
+from msmart.store import default_session_store
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
@@ -17,7 +18,7 @@ except ImportError:
 
 VERSION = '0.2.5'
 
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 
 Client = None
 _security = security()
@@ -50,16 +51,28 @@ class scandevice:
                 _device = await self.support_testv3(account, password)
             else:
                 _device = ac(self.ip, self.id, self.port)
-            if self.type == 'ac':
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(None, _device.refresh)
-                _LOGGER.debug("{}".format(_device))
-                self.support = _device.support
-        _LOGGER.debug("*** Found a device: \033[94m\033[1m{} \033[0m".format(self)) 
+            try:
+                if self.type == 'ac':
+                    loop = asyncio.get_event_loop()
+                    await loop.run_in_executor(None, _device.refresh)
+                    _LOGGER.debug("{}", _device)
+                    self.support = _device.support
+            finally:
+                # The test device is thrown away, give its pooled session back
+                _device.close()
+        _LOGGER.debug("*** Found a device: \033[94m\033[1m{} \033[0m", self) 
         return self
 
     async def support_testv3(self, account, password):
         _device = ac(self.ip, self.id, self.port)
+        loop = asyncio.get_event_loop()
+        # Try the stored token/key pair before logging in to the cloud
+        store = default_session_store()
+        if store:
+            token, key = store.get_token_key(self.id)
+            if token and await loop.run_in_executor(None, _device.authenticate, key, token):
+                self.token, self.key = token, key
+                return _device
         for udpid in [get_udpid(self.id.to_bytes(6, 'little')), get_udpid(self.id.to_bytes(6, 'big'))]:
             loop = asyncio.get_event_loop()
             token, key = await loop.run_in_executor(None, gettoken, udpid, account, password)
@@ -94,7 +107,7 @@ class scandeviceV2V3(scandevice):
         encrypt_data = data[40:-16]
         reply = _security.aes_decrypt(encrypt_data)
         self.ip = '.'.join([str(i) for i in reply[3::-1]])
-        _LOGGER.debug("Decrypt Reply: {} {}".format(self.ip, reply.hex()))
+        _LOGGER.debug("Decrypt Reply: {} {}", self.ip, lazy_hex(reply))
         self.port = int.from_bytes(reply[4:8], 'little')
         self.sn = reply[11:40].decode("utf-8")
         self.model = self.sn[9:14]
@@ -142,24 +155,20 @@ class scandeviceV1(scandevice):
             sock.connect(device_address)
 
             # Send data
-            _LOGGER.debug("Sending to {}:{} {}".format(
-                self.ip, self.port, DEVICE_INFO_MSG.hex()))
+            _LOGGER.debug("Sending to {}:{} {}", self.ip, self.port, lazy_hex(DEVICE_INFO_MSG))
             sock.sendall(DEVICE_INFO_MSG)
 
             # Received data
             response = sock.recv(512)
         except socket.error:
-            _LOGGER.info("Couldn't connect with Device {}:{}".format(
-                self.ip, self.port))
+            _LOGGER.info("Couldn't connect with Device {}:{}", self.ip, self.port)
             return bytearray(0)
         except socket.timeout:
-            _LOGGER.info("Connect the Device {}:{} TimeOut for 8s. don't care about a small amount of this. if many maybe not support".format(
-                self.ip, self.port))
+            _LOGGER.info("Connect the Device {}:{} TimeOut for 8s. don't care about a small amount of this. if many maybe not support", self.ip, self.port)
             return bytearray(0)
         finally:
             sock.close()
-        _LOGGER.debug("Received from {}:{} {}".format(
-            self.ip, self.port, response.hex()))
+        _LOGGER.debug("Received from {}:{} {}", self.ip, self.port, lazy_hex(response))
         return response
 
 class MideaDiscovery:
@@ -213,7 +222,7 @@ class MideaDiscovery:
             else:
                 ip = addr[0]
             if ip not in self.found_devices:
-                _LOGGER.debug("Midea Local Data {} {}".format(ip, data.hex()))
+                _LOGGER.debug("Midea Local Data {} {}", ip, lazy_hex(data))
                 self.found_devices.add(ip)
                 device = await scandevice.load(ip, data)
                 device.run_test = self.run_test
@@ -0,0 +1,128 @@
+# -*- coding: UTF-8 -*-
+import struct
+
+VERSION = '0.2.5'
+
+
+class field:
+    '''
+    One value in a frame: (byte >> shift) & mask at offset, a flag that is
+    set when any bit of mask is set, a little endian u16, or constant bits
+    that are only written by pack.
+    '''
+    __slots__ = ('name', 'offset', 'shift', 'mask', 'kind')
+
+    def __init__(self, name, offset, shift=0, mask=0xFF, kind='int'):
+        self.name = name
+        self.offset = offset
+        self.shift = shift
+        self.mask = mask
+        self.kind = kind
+
+
+def byte(name, offset):
+    return field(name, offset)
+
+
+def bits(name, offset, start, end):
+    # Bits start to end inclusive, like utils.getBits
+    return field(name, offset, start, (1 << (end - start + 1)) - 1)
+
+
+def flag(name, offset, mask):
+    return field(name, offset, mask=mask, kind='flag')
+
+
+def u16(name, offset):
+    return field(name, offset, mask=0xFFFF, kind='u16')
+
+
+def const(offset, value):
+    return field(None, offset, mask=value, kind='const')
+
+
+class record:
+    '''Base of the slotted records produced by schema.unpack.'''
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ', '.join(
+            "{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def _asdict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class schema:
+    '''
+    Frame layout compiled once into a struct.Struct and generated pack and
+    unpack functions. unpack(buffer) returns a slotted record, buffers
+    shorter than size read as zero padded. pack(**values) returns bytes,
+    missing values pack as 0.
+    '''
+
+    def __init__(self, name, size, fields):
+        self.name = name
+        self.size = size
+        self.fields = tuple(fields)
+        self.names = tuple(f.name for f in self.fields if f.name is not None)
+        self.record = type(name, (record,), {'__slots__': self.names})
+
+        # One struct code per byte, u16 fields take two
+        codes = ['x'] * size
+        for f in self.fields:
+            if f.kind == 'u16':
+                codes[f.offset], codes[f.offset + 1] = 'H', ''
+            elif codes[f.offset] == 'x':
+                codes[f.offset] = 'B'
+        self.struct = struct.Struct('<' + ''.join(codes))
+        offsets = [offset for offset, code in enumerate(codes) if code in ('B', 'H')]
+        self._compile(offsets)
+
+    @staticmethod
+    def _unpack_expression(f):
+        value = 'b{}'.format(f.offset)
+        if f.kind == 'flag':
+            return '({} & {}) != 0'.format(value, f.mask)
+        if f.kind == 'u16' or (f.shift == 0 and f.mask == 0xFF):
+            return value
+        return '({} >> {}) & {}'.format(value, f.shift, f.mask)
+
+    @staticmethod
+    def _pack_expression(f):
+        if f.kind == 'const':
+            return str(f.mask)
+        if f.kind == 'flag':
+            return '({} if {} else 0)'.format(f.mask, f.name)
+        return '(({} & {}) << {})'.format(f.name, f.mask, f.shift)
+
+    def _compile(self, offsets):
+        variables = ', '.join('b{}'.format(offset) for offset in offsets)
+        unpacked = [f for f in self.fields if f.name is not None]
+        lines = [
+            'def __init__(self, {}):'.format(', '.join(self.names)),
+        ] + ['    self.{0} = {0}'.format(name) for name in self.names] + [
+            '',
+            'def unpack(buffer):',
+            '    if len(buffer) < {}:'.format(self.size),
+            '        buffer = bytes(buffer) + bytes({} - len(buffer))'.format(self.size),
+            '    {}, = unpack_from(buffer)'.format(variables),
+            '    return record({})'.format(', '.join(self._unpack_expression(f) for f in unpacked)),
+            '',
+            'def pack({}):'.format(', '.join('{}=0'.format(name) for name in self.names)),
+            '    return pack_struct({})'.format(', '.join(
+                ' | '.join(self._pack_expression(f) for f in self.fields if f.offset == offset) or '0'
+                for offset in offsets)),
+        ]
+        namespace = {'unpack_from': self.struct.unpack_from, 'pack_struct': self.struct.pack,
+                     'record': self.record}
+        exec(compile('\n'.join(lines), '<schema {}>'.format(self.name), 'exec'), namespace)
+        self.record.__init__ = namespace['__init__']
+        self.unpack = namespace['unpack']
+        self.pack = namespace['pack']
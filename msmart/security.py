@@ -1,12 +1,10 @@
 # -*- coding: UTF-8 -*-
-import logging
 import urllib
-from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
-from Crypto.Util.strxor import strxor
-from Crypto.Random import get_random_bytes
 from hashlib import md5, sha256
 from msmart.const import MSGTYPE_ENCRYPTED_REQUEST, MSGTYPE_ENCRYPTED_RESPONSE
+from msmart.crypto_backend import get_backend
+from msmart.log import get_logger, lazy_hex
 from urllib.parse import urlparse
 import hmac
 import collections
@@ -14,19 +12,29 @@ from typing import Any, Dict, List, Optional, Tuple
 import os
 
 VERSION = '0.2.5'
-_LOGGER = logging.getLogger(__name__)
+_LOGGER = get_logger(__name__)
 appKey = '434a209a5ce141c3b726de067835d7f0'
 signKey = 'xhdiwjnchekd4d512chdjx5d8e4c394D2D7S'
 
+# Derived once and shared by every security instance
+key_material = collections.namedtuple('key_material', ['app_key', 'sign_key', 'enc_key', 'dynamic_key'])
+KEY_MATERIAL = key_material(
+    app_key=appKey.encode(),
+    sign_key=signKey.encode(),
+    enc_key=md5(signKey.encode()).digest(),
+    # Use only half of the hash
+    dynamic_key=md5(appKey.encode()).digest()[:8])
+
+
 class security:
 
     def __init__(self, use_china_server=False):
-        self.appKey = appKey.encode()
-        self.signKey = signKey.encode()
+        self.appKey = KEY_MATERIAL.app_key
+        self.signKey = KEY_MATERIAL.sign_key
         self.blockSize = 16
         self.iv = b'\0' * 16
-        self.encKey = self.enc_key()
-        self.dynamicKey = self.dynamic_key()
+        self.encKey = KEY_MATERIAL.enc_key
+        self.dynamicKey = KEY_MATERIAL.dynamic_key
         self._tcp_key = None
         self._request_count = 0
         self._response_count = 0
@@ -43,42 +51,41 @@ class security:
             self._loginKey = 'ad0ee21d48a64bf49f4fb583ab76e799'
 
     def aes_decrypt(self, raw):
-        cipher = AES.new(self.encKey, AES.MODE_ECB)
         try:
-            decrypted = cipher.decrypt(bytes(raw))
+            decrypted = get_backend().ecb_decrypt(self.encKey, raw)
 
             # Remove the padding
             decrypted = unpad(decrypted, self.blockSize)
             return decrypted
         except ValueError as e:
             _LOGGER.error(
-                "aes_decrypt error: {} - data: {}".format(repr(e), raw.hex()))
+                "aes_decrypt error: {} - data: {}", repr(e), lazy_hex(raw))
             return bytearray(0)
 
     def aes_encrypt(self, raw):
         # Make sure to pad the data
         raw = pad(raw, self.blockSize)
 
-        cipher = AES.new(self.encKey, AES.MODE_ECB)
-        encrypted = cipher.encrypt(bytes(raw))
+        encrypted = get_backend().ecb_encrypt(self.encKey, bytes(raw))
 
         return encrypted
 
     def aes_cbc_decrypt(self, raw, key):
-        return AES.new(key, AES.MODE_CBC, iv=self.iv).decrypt(raw)
+        return get_backend().cbc_decrypt(key, raw)
 
     def aes_cbc_encrypt(self, raw, key):
-        return AES.new(key, AES.MODE_CBC, iv=self.iv).encrypt(raw)
+        return get_backend().cbc_encrypt(key, raw)
 
     def enc_key(self):
-        return md5(self.signKey).digest()
+        return KEY_MATERIAL.enc_key
 
     def dynamic_key(self):
-        # Use only half of the hash
-        return md5(self.appKey).digest()[:8]
+        return KEY_MATERIAL.dynamic_key
 
     def encode32_data(self, raw):
-        return md5(raw + self.signKey).digest()
+        digest = md5(raw)
+        digest.update(self.signKey)
+        return digest.digest()
 
     def local_key(self, mac: str, ssid: str, pw: str):
         mac = bytes.fromhex(mac.replace(':', ''))
@@ -90,8 +97,8 @@ class security:
 
     def token_key_pair(self, mac: str, ssid: str, pw: str):
         local_key = self.local_key(mac, ssid, pw)
-        rand = get_random_bytes(32)
-        key = strxor(rand, local_key)
+        rand = get_backend().random_bytes(32)
+        key = get_backend().xor(rand, local_key)
         token = self.aes_cbc_encrypt(key, local_key)
         sign = sha256(key).digest()
         return (token + sign, key)
@@ -109,63 +116,79 @@ class security:
         if sha256(plain).digest() != sign:
             _LOGGER.error("sign does not match")
             return b'', False
-        self._tcp_key = strxor(plain, key)
+        self._tcp_key = get_backend().xor(plain, bytes(key))
         self._request_count = 0
         self._response_count = 0
         return self._tcp_key, True
 
+    def set_tcp_key(self, tcp_key):
+        # Resume a previously negotiated session
+        self._tcp_key = tcp_key
+        self._request_count = 0
+        self._response_count = 0
+
     def encode_8370(self, data, msgtype):
-        header = bytes([0x83, 0x70])
-        size, padding = len(data), 0
-        if msgtype in (MSGTYPE_ENCRYPTED_RESPONSE, MSGTYPE_ENCRYPTED_REQUEST):
-            if (size + 2) % 16 != 0:
-                padding = 16 - (size + 2 & 0xf)
-                size += padding + 32
-                data += get_random_bytes(padding)
-        header += size.to_bytes(2, 'big')
-        header += bytes([0x20, padding << 4 | msgtype])
+        # Built in one preallocated frame: header, count, data, padding, sign
+        encrypted = msgtype in (MSGTYPE_ENCRYPTED_RESPONSE, MSGTYPE_ENCRYPTED_REQUEST)
+        length = len(data)
+        size, padding = length, 0
+        if encrypted:
+            if (length + 2) % 16 != 0:
+                padding = 16 - (length + 2 & 0xf)
+            size += padding + 32
         if self._request_count >= 0xfff:
-            _LOGGER.info("request_count is too big to convert: {}".format(self._request_count))
+            _LOGGER.info("request_count is too big to convert: {}", self._request_count)
             self._request_count = 0 
-        data = self._request_count.to_bytes(2, 'big') + data
+        frame = bytearray(size + 8)
+        frame[0:6] = (0x83, 0x70, size >> 8, size & 0xff, 0x20, padding << 4 | msgtype)
+        frame[6:8] = self._request_count.to_bytes(2, 'big')
+        frame[8:8 + length] = data
+        if padding:
+            frame[8 + length:8 + length + padding] = get_backend().random_bytes(padding)
         self._request_count += 1
-        if msgtype in (MSGTYPE_ENCRYPTED_RESPONSE, MSGTYPE_ENCRYPTED_REQUEST):
-            sign = sha256(header + data).digest()
-            data = self.aes_cbc_encrypt(data, self._tcp_key) + sign
-        return header + data
+        if encrypted:
+            with memoryview(frame) as view:
+                frame[-32:] = get_backend().sign(view[:-32])
+                frame[6:-32] = self.aes_cbc_encrypt(view[6:-32], self._tcp_key)
+        return frame
 
     def decode_8370(self, data):
-        if len(data) < 6:
-            return [], data
-        header = data[:6]
-        if header[0] != 0x83 or header[1] != 0x70:
-            raise Exception('not an 8370 message')
-        size = int.from_bytes(header[2:4], 'big') + 8
-        leftover = None
-        if len(data) < size:
-            return [], data
-        elif len(data) > size:
-            leftover = data[size:]
-            data = data[:size]
-        if header[4] != 0x20:
-            raise Exception('missing byte 4')
-        padding = header[5] >> 4
-        msgtype = header[5] & 0xf
-        data = data[6:]
-        if msgtype in (MSGTYPE_ENCRYPTED_RESPONSE, MSGTYPE_ENCRYPTED_REQUEST):
-            sign = data[-32:]
-            data = data[:-32]
-            data = self.aes_cbc_decrypt(data, self._tcp_key)
-            if sha256(header + data).digest() != sign:
-                raise Exception('sign does not match')
-            if padding:
-                data = data[:-padding]
-        self._response_count = int.from_bytes(data[:2], 'big')
-        data = data[2:]
-        if leftover:
-            packets, incomplete = self.decode_8370(leftover)
-            return [data] + packets, incomplete
-        return [data], b''
+        packets, leftover = self.decode_8370_views(data)
+        return [bytes(packet) for packet in packets], bytes(leftover)
+
+    def decode_8370_views(self, data):
+        '''
+        Decode every complete 8370 message in data in a single pass.
+        Returns the payloads as memoryviews over the input or the decrypted
+        block, together with a view of any incomplete tail.
+        '''
+        view = memoryview(data)
+        end = len(view)
+        packets = []
+        offset = 0
+        while end - offset >= 6:
+            if view[offset] != 0x83 or view[offset + 1] != 0x70:
+                raise Exception('not an 8370 message')
+            size = (view[offset + 2] << 8 | view[offset + 3]) + 8
+            if end - offset < size:
+                break
+            if view[offset + 4] != 0x20:
+                raise Exception('missing byte 4')
+            padding = view[offset + 5] >> 4
+            msgtype = view[offset + 5] & 0xf
+            start, stop = offset + 6, offset + size
+            if msgtype in (MSGTYPE_ENCRYPTED_RESPONSE, MSGTYPE_ENCRYPTED_REQUEST):
+                sign = stop - 32
+                plain = self.aes_cbc_decrypt(view[start:sign], self._tcp_key)
+                if get_backend().sign(view[offset:start].tobytes() + plain) != view[sign:stop]:
+                    raise Exception('sign does not match')
+                self._response_count = plain[0] << 8 | plain[1]
+                packets.append(memoryview(plain)[2:len(plain) - padding])
+            else:
+                self._response_count = view[start] << 8 | view[start + 1]
+                packets.append(view[start + 2:stop])
+            offset = stop
+        return packets, view[offset:]
 
     def sign(self, url, payload):
         # We only need the path
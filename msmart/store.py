@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+import json
+import os
+import threading
+import time
+from msmart.log import get_logger
+
+VERSION = '0.2.5'
+
+_LOGGER = get_logger(__name__)
+
+# Token/key pairs stay valid until the device is paired again
+TOKEN_TTL = 30 * 24 * 3600
+# Negotiated 8370 sessions are only worth resuming for a short while
+SESSION_TTL = 3600
+# Capabilities only change with the firmware
+CAPABILITY_TTL = 90 * 24 * 3600
+
+
+class json_store:
+    '''
+    Small JSON file backed dict where every entry expires after a TTL.
+    The file is rewritten atomically and is only readable by the owner.
+    '''
+
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+        self._lock = threading.Lock()
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self._path, 'r') as f:
+                    self._data = json.load(f)
+            except FileNotFoundError:
+                self._data = {}
+            except (OSError, ValueError) as error:
+                _LOGGER.warning("Unable to read {}: {}", self._path, error)
+                self._data = {}
+        return self._data
+
+    def _save(self):
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self._path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._data, f)
+            os.replace(tmp, self._path)
+        except OSError as error:
+            _LOGGER.warning("Unable to write {}: {}", self._path, error)
+
+    def get(self, key, default=None):
+        key = str(key)
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is None:
+                return default
+            if entry['expires'] < time.time():
+                del self._data[key]
+                self._save()
+                return default
+            return entry['value']
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._load()[str(key)] = {'value': value, 'expires': time.time() + ttl}
+            self._save()
+
+    def delete(self, key):
+        with self._lock:
+            if self._load().pop(str(key), None) is not None:
+                self._save()
+
+
+class session_store(json_store):
+    '''
+    Per device id cache of cloud token/key pairs and negotiated 8370 sessions.
+    '''
+
+    def get_token_key(self, device_id):
+        value = self.get('token:{}'.format(device_id))
+        if value is None:
+            return None, None
+        return value['token'], value['key']
+
+    def set_token_key(self, device_id, token, key, ttl=TOKEN_TTL):
+        self.set('token:{}'.format(device_id), {'token': token, 'key': key}, ttl)
+
+    def get_session(self, device_id):
+        if not self.resumable(device_id):
+            return None
+        return self.get('session:{}'.format(device_id))
+
+    def set_session(self, device_id, tcp_key, ttl=SESSION_TTL):
+        if self.resumable(device_id):
+            self.set('session:{}'.format(device_id), tcp_key, ttl)
+
+    def resumable(self, device_id):
+        return self.get('noresume:{}'.format(device_id)) is None
+
+    def disable_resume(self, device_id, ttl=TOKEN_TTL):
+        # The device wants a fresh handshake on every connection
+        self.delete('session:{}'.format(device_id))
+        self.set('noresume:{}'.format(device_id), True, ttl)
+
+
+class capability_store(json_store):
+    '''
+    Capabilities reported by devices, keyed by model (or serial number when
+    the model is unknown) so a restart does not need to query them again.
+    '''
+
+    def get_capabilities(self, key):
+        return self.get('capabilities:{}'.format(key))
+
+    def set_capabilities(self, key, capabilities, ttl=CAPABILITY_TTL):
+        self.set('capabilities:{}'.format(key), capabilities, ttl)
+
+
+_default_store = None
+_default_capability_store = None
+
+
+def default_session_store():
+    # Enabled by pointing MSMART_SESSION_STORE at a file
+    global _default_store
+    path = os.getenv('MSMART_SESSION_STORE')
+    if not path:
+        return None
+    if _default_store is None or _default_store._path != os.path.expanduser(path):
+        _default_store = session_store(path)
+    return _default_store
+
+
+def default_capability_store():
+    # Enabled by pointing MSMART_CAPABILITY_STORE at a file
+    global _default_capability_store
+    path = os.getenv('MSMART_CAPABILITY_STORE')
+    if not path:
+        return None
+    if _default_capability_store is None or _default_capability_store._path != os.path.expanduser(path):
+        _default_capability_store = capability_store(path)
+    return _default_capability_store
@@ -30,4 +30,8 @@ setuptools.setup(
         "requests",
         "ifaddr"
     ],
+    extras_require={
+        "cryptography": ["cryptography"],
+        "numpy": ["numpy"],
+    },
 )